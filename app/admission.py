@@ -0,0 +1,182 @@
+"""Admission control in front of the AI API.
+
+Chat turns wait for one of LLM_MAX_CONCURRENCY slots before doing any work.
+At most LLM_QUEUE_SIZE turns wait at a time, each for at most
+LLM_QUEUE_TIMEOUT_SECONDS (or less, if the client sends a shorter
+X-Request-Timeout). A turn that cannot get a slot in time is refused at once
+with 503 and a Retry-After estimate, rather than queued until the client gives
+up and retries. Each client is also rate limited by a token bucket (429).
+
+Waiting turns hold no database connection, so reads such as /conversations
+are served whatever the chat load. A turn takes its slot only once it holds
+the lock of its conversation: turns queued behind another turn of the same
+conversation make no AI API call, so they hold no slot either. Like the other
+limits of this app, these are per process.
+"""
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+from fastapi import HTTPException
+import asyncio
+import math
+import os
+import time
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "256"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10"))
+# Chat requests per minute allowed per client, after a burst of RATE_LIMIT_BURST; 0 disables rate limiting
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "60"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+# Clients whose buckets are remembered; the least recently seen are forgotten (and start full again)
+RATE_LIMIT_MAX_CLIENTS = 10000
+
+# Weight of the latest turn in the running average of slot hold times
+_HOLD_TIME_SMOOTHING = 0.1
+
+def _retry_after(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token. Returns 0 on success, otherwise the seconds until one is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """One token bucket per client"""
+
+    def __init__(self, per_minute: float = RATE_LIMIT_PER_MINUTE, burst: int = RATE_LIMIT_BURST,
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_clients = max_clients
+        self.rejected = 0
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def check(self, client: str):
+        """Count a request of `client`, raising 429 if it is over its rate"""
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = TokenBucket(self.rate, self.burst, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client)
+
+        wait = bucket.take(now)
+        if wait:
+            self.rejected += 1
+            raise HTTPException(status_code=429, detail="Too many requests", headers=_retry_after(wait))
+
+    def clear(self):
+        self._buckets.clear()
+
+class AdmissionController:
+    """A bounded FIFO queue in front of a fixed number of AI API slots"""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, queue_size: int = LLM_QUEUE_SIZE,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT_SECONDS):
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        # Running average of how long a turn holds its slot; unknown until the first turn ends
+        self.hold_seconds: Optional[float] = None
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def estimated_wait(self) -> float:
+        """Seconds a turn arriving now should wait for a slot"""
+        if self.active < self.max_concurrency or self.hold_seconds is None:
+            return 0.0
+        # Slots free up at max_concurrency / hold_seconds per second, and every waiter goes first
+        return (self.waiting + 1) * self.hold_seconds / self.max_concurrency
+
+    @asynccontextmanager
+    async def admit(self, timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """Hold a slot for the block. `timeout` is the client's own deadline for the whole request.
+
+        Raises 503 when the queue is full, or when a slot is not expected
+        (or does not come) in time to answer before the deadline.
+        """
+        budget = self.queue_timeout
+        if timeout is not None:
+            # Leave time for the turn itself
+            budget = min(budget, timeout - (self.hold_seconds or 0.0))
+
+        if self.active >= self.max_concurrency or self._waiters:
+            estimate = self.estimated_wait()
+            if self.waiting >= self.queue_size:
+                self.rejected_queue_full += 1
+                raise HTTPException(status_code=503, detail="Server busy, retry later", headers=_retry_after(estimate))
+            if estimate > budget or budget <= 0:
+                self.rejected_deadline += 1
+                raise HTTPException(status_code=503, detail="Server busy, retry later", headers=_retry_after(estimate))
+            await self._wait(budget)
+        else:
+            self.active += 1
+
+        self.admitted += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - started
+            self.hold_seconds = held if self.hold_seconds is None \
+                else self.hold_seconds + _HOLD_TIME_SMOOTHING * (held - self.hold_seconds)
+            self._release()
+
+    async def _wait(self, budget: float):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), budget)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                self.rejected_deadline += 1
+                raise HTTPException(status_code=503, detail="Server busy, retry later",
+                                    headers=_retry_after(self.estimated_wait())) from None
+            # The slot was handed over just as the wait ended: keep it
+        except BaseException:
+            if waiter.done():
+                # The slot was handed over, but the request went away
+                self._release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        # Hand the slot straight to the oldest waiter, so it cannot be taken by a newcomer
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+rate_limiter = RateLimiter()
+admission = AdmissionController()
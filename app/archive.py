@@ -0,0 +1,130 @@
+"""Compressed storage for the messages of idle conversations.
+
+Each archived conversation is one gzip'd NDJSON file of its messages, in id
+order, written by app/retention.py. Readers merge it with any messages the
+conversation received after it was archived, which are still in the database.
+Pages are read from both and merged, so paging never loads a whole archive.
+"""
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import asyncio
+import datetime
+import gzip
+import json
+import os
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+
+class ArchivedMessage(NamedTuple):
+    # Same fields, in the same order, as the rows of the message queries
+    id: int
+    role: str
+    content: str
+    created_at: Optional[datetime.datetime]
+
+class ArchiveStore:
+    def __init__(self, directory: str = ARCHIVE_DIR):
+        self.directory = directory
+
+    def path(self, conversation_id: str) -> str:
+        # Sharded by id prefix, to keep directories small
+        return os.path.join(self.directory, conversation_id[:2], f"{conversation_id}.ndjson.gz")
+
+    def exists(self, conversation_id: str) -> bool:
+        return os.path.exists(self.path(conversation_id))
+
+    def read(self, conversation_id: str) -> List[ArchivedMessage]:
+        """Archived messages of a conversation, oldest first; empty if it has no archive"""
+        return list(self._iter_messages(conversation_id))
+
+    def read_page(self, conversation_id: str, limit: int = 20, desc: bool = False,
+                  after_id: Optional[int] = None, before_id: Optional[int] = None) -> Tuple[List[ArchivedMessage], bool]:
+        """One page of archived messages, with the arguments and results of Conversation.load_messages_page (without skip).
+
+        The file is decompressed only up to the page, or up to the cursor when
+        paging towards older messages; at most `limit` + 1 messages are held.
+        """
+        lower_id, upper_id = (before_id, after_id) if desc else (after_id, before_id)
+        walking_backwards = before_id is not None and after_id is None
+        towards_newer = walking_backwards == desc
+        # Towards older messages, the page is the last ones read before the cursor
+        selected: Deque[ArchivedMessage] = deque(maxlen=None if towards_newer else limit + 1)
+        for message in self._iter_messages(conversation_id):
+            if lower_id is not None and message.id <= lower_id:
+                continue
+            if upper_id is not None and message.id >= upper_id:
+                break
+            selected.append(message)
+            if towards_newer and len(selected) > limit:
+                break
+
+        messages = list(selected) if towards_newer else list(reversed(selected))
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if walking_backwards:
+            messages.reverse()
+        return messages, has_more
+
+    def write(self, conversation_id: str, messages: Iterable[ArchivedMessage]):
+        """Replace the archive of a conversation. The file is swapped in atomically."""
+        path = self.path(conversation_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+            for message in messages:
+                archive.write((json.dumps(self._to_json(message)) + "\n").encode("utf-8"))
+            archive.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(temporary_path, path)
+
+    async def read_async(self, conversation_id: str) -> List[ArchivedMessage]:
+        return await asyncio.to_thread(self.read, conversation_id)
+
+    async def read_page_async(self, conversation_id: str, **kwargs) -> Tuple[List[ArchivedMessage], bool]:
+        return await asyncio.to_thread(self.read_page, conversation_id, **kwargs)
+
+    def _iter_messages(self, conversation_id: str) -> Iterator[ArchivedMessage]:
+        try:
+            with gzip.open(self.path(conversation_id), "rt", encoding="utf-8") as archive:
+                for line in archive:
+                    if line.strip():
+                        yield self._from_json(json.loads(line))
+        except FileNotFoundError:
+            return
+
+    @staticmethod
+    def _to_json(message: ArchivedMessage) -> Dict[str, Any]:
+        return {"id": message.id, "role": message.role, "content": message.content,
+                "created_at": message.created_at.isoformat() if message.created_at is not None else None}
+
+    @staticmethod
+    def _from_json(data: Dict[str, Any]) -> ArchivedMessage:
+        created_at = datetime.datetime.fromisoformat(data["created_at"]) if data.get("created_at") else None
+        return ArchivedMessage(data["id"], data["role"], data["content"], created_at)
+
+def merge_messages(archived: Sequence[ArchivedMessage], recent: Sequence[Any]) -> List[Any]:
+    """Archived messages followed by the database rows newer than them, in id order"""
+    last_archived_id = archived[-1].id if archived else 0
+    return list(archived) + [row for row in recent if row.id > last_archived_id]
+
+def merge_pages(archived: Sequence[ArchivedMessage], archived_has_more: bool, recent: Sequence[Any], recent_has_more: bool,
+                limit: int = 20, desc: bool = False, walking_backwards: bool = False, skip: int = 0) -> Tuple[List[Any], bool]:
+    """Merge the pages read from the archive and the database into the page of the whole conversation.
+
+    Each page must hold the `skip` + `limit` messages nearest the cursor, in
+    the requested order, as returned by ArchiveStore.read_page and
+    Conversation.load_messages_page. Messages in both are taken from the archive.
+    """
+    merged = {msg.id: msg for msg in recent}
+    merged.update((msg.id, msg) for msg in archived)
+    ordered = [merged[message_id] for message_id in sorted(merged, reverse=desc)]
+    more_beyond = archived_has_more or recent_has_more
+    if walking_backwards:
+        # The page ends `skip` messages before the cursor
+        end = max(len(ordered) - skip, 0)
+        start = max(end - limit, 0)
+        return ordered[start:end], start > 0 or more_beyond
+    return ordered[skip:skip + limit], len(ordered) > skip + limit or more_beyond
+
+archive_store = ArchiveStore()
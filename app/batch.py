@@ -0,0 +1,205 @@
+"""Run debate turns in bulk from a JSONL file.
+
+Each input line is a ChatRequest-shaped record:
+
+    {"id": "q1", "conversation_key": "cats", "message": "Cats are better than dogs"}
+    {"id": "q2", "conversation_key": "cats", "message": "They are cleaner, too"}
+
+Records sharing a `conversation_key` form one conversation, answered in file
+order; a record may instead continue an existing `conversation_id`. Different
+conversations run concurrently, up to --concurrency turns at a time.
+
+Results are appended to the output file as JSONL as they complete, which is
+also the checkpoint: running the same command again skips the records that
+already succeeded and continues their conversations.
+
+    python -m app.batch requests.jsonl --output results.jsonl --concurrency 32
+"""
+from fastapi import HTTPException
+from pydantic import ValidationError
+from typing import Any, Awaitable, Callable, Dict, Iterable, Iterator, Optional, Set, TextIO, Tuple
+from app.chat import ChatRequest, ChatResponse, run_turn
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+TurnFunc = Callable[[ChatRequest], Awaitable[ChatResponse]]
+
+async def run_chat_turn(request: ChatRequest) -> ChatResponse:
+    """Run a turn like POST /chat does, with its own database session"""
+    from app.database import SessionLocal
+
+    async with SessionLocal() as db:
+        return await run_turn(request, db)
+
+def read_records(lines: Iterable[str], id_field: str = "id", message_field: str = "message") -> Iterator[Tuple[str, Any]]:
+    """Yield (record id, record) pairs; records that cannot be parsed are yielded as their error message"""
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield f"line-{line_number}", f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield f"line-{line_number}", "Record is not a JSON object"
+            continue
+        if message_field != "message" and message_field in record:
+            record = {**record, "message": record[message_field]}
+        yield str(record.get(id_field, f"line-{line_number}")), record
+
+def load_checkpoint(lines: Iterable[str]) -> Tuple[Set[str], Dict[str, str]]:
+    """Read the ids of the records that succeeded, and the conversation of each conversation_key"""
+    completed: Set[str] = set()
+    conversation_ids: Dict[str, str] = {}
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except json.JSONDecodeError:
+            # A line cut short by an interrupted run
+            continue
+        if result.get("status") != "ok":
+            continue
+        completed.add(result["id"])
+        if result.get("conversation_key"):
+            conversation_ids[result["conversation_key"]] = result["conversation_id"]
+    return completed, conversation_ids
+
+class BatchRunner:
+    def __init__(self, output: TextIO, concurrency: int = 16, max_pending: Optional[int] = None,
+                 turn: TurnFunc = run_chat_turn, completed: Iterable[str] = (),
+                 conversation_ids: Optional[Dict[str, str]] = None):
+        self.output = output
+        self.turn = turn
+        self.completed = set(completed)
+        self.conversation_ids: Dict[str, str] = dict(conversation_ids or {})
+        self.counts = {"ok": 0, "error": 0, "skipped": 0, "resumed": 0}
+        # Turns running at once, and records read ahead of them, so huge files are not loaded in memory
+        self._slots = asyncio.Semaphore(concurrency)
+        self._pending = asyncio.Semaphore(max_pending or 4 * concurrency)
+        # Last task of each conversation, which the next turn of the conversation waits for
+        self._tails: Dict[str, asyncio.Task] = {}
+
+    async def run(self, records: Iterable[Tuple[str, Any]]) -> Dict[str, int]:
+        tasks: Set[asyncio.Task] = set()
+        for record_id, record in records:
+            if record_id in self.completed:
+                self.counts["resumed"] += 1
+                continue
+            await self._pending.acquire()
+            key = self._conversation_key(record_id, record)
+            task = asyncio.create_task(self._process(record_id, key, record, self._tails.get(key)))
+            self._tails[key] = task
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        return self.counts
+
+    @staticmethod
+    def _conversation_key(record_id: str, record: Any) -> str:
+        if isinstance(record, dict):
+            if record.get("conversation_key"):
+                return f"key:{record['conversation_key']}"
+            if record.get("conversation_id"):
+                return f"id:{record['conversation_id']}"
+        return f"record:{record_id}"
+
+    async def _process(self, record_id: str, key: str, record: Any, previous: Optional[asyncio.Task]) -> bool:
+        conversation_key = record.get("conversation_key") if isinstance(record, dict) else None
+        result: Dict[str, Any] = {"id": record_id, "conversation_key": conversation_key}
+        try:
+            # Keep the turn order of a conversation: wait for its previous turn
+            if previous is not None and not await previous:
+                self._write(result, status="skipped", error="An earlier turn of this conversation failed")
+                return False
+            if isinstance(record, str):
+                self._write(result, status="error", error=record)
+                return False
+
+            try:
+                request = ChatRequest(
+                    conversation_id=record.get("conversation_id") or self.conversation_ids.get(conversation_key or ""),
+                    message=record.get("message")
+                )
+            except ValidationError as e:
+                self._write(result, status="error", error=str(e))
+                return False
+
+            async with self._slots:
+                started = time.perf_counter()
+                try:
+                    response = await self.turn(request)
+                except HTTPException as e:
+                    self._write(result, status="error", error=str(e.detail), conversation_id=request.conversation_id)
+                    return False
+                except Exception as e:
+                    logger.exception("Turn %s failed", record_id)
+                    self._write(result, status="error", error=str(e), conversation_id=request.conversation_id)
+                    return False
+                elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+
+            if conversation_key:
+                self.conversation_ids[conversation_key] = response.conversation_id
+            self._write(
+                result,
+                status="ok",
+                conversation_id=response.conversation_id,
+                reply=response.message[-1].message if response.message else None,
+                elapsed_ms=elapsed_ms
+            )
+            return True
+        finally:
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+            self._pending.release()
+
+    def _write(self, result: Dict[str, Any], status: str, **fields):
+        self.counts[status] += 1
+        self.output.write(json.dumps({**result, "status": status, **fields}) + "\n")
+        self.output.flush()
+
+async def run_batch(input_path: str, output_path: str, concurrency: int, id_field: str, message_field: str) -> Dict[str, int]:
+    from app.database import engine
+    from app.openai_response import close_client
+    from app.summary import wait_for_summary_updates
+
+    completed: Set[str] = set()
+    conversation_ids: Dict[str, str] = {}
+    if os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as previous_results:
+            completed, conversation_ids = load_checkpoint(previous_results)
+
+    try:
+        with open(input_path, encoding="utf-8") as input_file, open(output_path, "a", encoding="utf-8") as output:
+            runner = BatchRunner(output, concurrency=concurrency, completed=completed, conversation_ids=conversation_ids)
+            return await runner.run(read_records(input_file, id_field, message_field))
+    finally:
+        await wait_for_summary_updates()
+        await close_client()
+        await engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL file of ChatRequest records")
+    parser.add_argument("--output", "-o", default=None, help="JSONL results file, also used to resume (default: <input>.results.jsonl)")
+    parser.add_argument("--concurrency", "-c", type=int, default=16, help="Turns run at the same time")
+    parser.add_argument("--id-field", default="id", help="Field holding a unique record id (default: the line number)")
+    parser.add_argument("--message-field", default="message", help="Field holding the user message")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    output_path = args.output or os.path.splitext(args.input)[0] + ".results.jsonl"
+    counts = asyncio.run(run_batch(args.input, output_path, args.concurrency, args.id_field, args.message_field))
+    print(" ".join(f"{status}={count}" for status, count in counts.items()), file=sys.stderr)
+    sys.exit(1 if counts["error"] or counts["skipped"] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""A chat turn: shared by the API endpoints and the batch runner"""
+from fastapi import HTTPException
+from pydantic import BaseModel
+from contextlib import nullcontext
+from typing import AsyncContextManager, Callable, Dict, Optional, List, cast
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.topic import Topic
+from app.archive import ArchivedMessage, archive_store
+from app.conversation import Conversation, Message
+from app.debate import Debate
+from app.history_cache import history_cache
+from app.locks import conversation_locks
+from app.summary import SUMMARY_BATCH, schedule_summary_update
+from app.metrics import observe_stage
+import os
+
+class ChatRequest(BaseModel):
+    conversation_id: Optional[str] = None
+    message: str
+
+class ChatMessage(BaseModel):
+    role: str
+    message: str
+
+class ChatResponse(BaseModel):
+    conversation_id: str
+    message: List[ChatMessage]
+
+# Messages the summary leaves out: the window sent with each turn holds from HISTORY_LIMIT
+# to HISTORY_WINDOW messages, growing until a batch is folded into the summary
+HISTORY_LIMIT = 10
+# Messages kept per conversation: the history window plus the turns waiting to be summarized
+HISTORY_WINDOW = HISTORY_LIMIT + SUMMARY_BATCH
+# Max estimated tokens of history sent to the AI API with each message
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+
+async def prepare_turn(request: ChatRequest, db: AsyncSession) -> Conversation:
+    """Retrieve or start the conversation and set its topic.
+
+    Nothing is written here: the conversation and both messages of the turn are
+    written together by finish_turn once the bot has replied.
+    Conversations found in the history cache need no database read at all.
+    """
+    conversation_id = request.conversation_id
+    conversation: Optional[Conversation]
+
+    # 1 - Retrive Conversation
+    # 1.1 - Start a new conversation
+    if not conversation_id:
+        conversation = Conversation()
+        db.add(conversation)
+    elif (cached := history_cache.get(conversation_id)) is not None:
+        # 1.2 - Get existing conversation and its recent messages from the cache
+        conversation = cached
+        db.add(conversation)
+    else:
+        # The whole read is one db_read observation: query, end of the transaction and archive
+        with observe_stage("db_read"):
+            conversation = await _load_conversation(db, conversation_id)
+
+    # 2 - Set Topic and Stances if not set yet
+    if conversation.topic is None:
+        with observe_stage("topic_extraction"):
+            topic = await Topic.extract_topic_and_stances(request.message)
+
+        if topic.is_known():
+            conversation.topic = topic.topic
+            conversation.user_stance = topic.user_stance
+            conversation.bot_stance = topic.bot_stance
+
+    return conversation
+
+async def _load_conversation(db: AsyncSession, conversation_id: str) -> Conversation:
+    # 1.3 - Get existing conversation and its recent messages from database
+    conversation_obj = await Conversation.get_with_history(db, conversation_id, HISTORY_WINDOW)
+
+    if not isinstance(conversation_obj, Conversation):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    # Cast to Conversation type
+    conversation = cast(Conversation, conversation_obj)
+
+    # End the read transaction so no connection is held while waiting on the AI API
+    await db.commit()
+
+    # 1.4 - Complete the window from the archive for a conversation archived while idle
+    if conversation.archived_at is not None and len(conversation.recent_messages) < HISTORY_WINDOW:
+        first_id = conversation.recent_messages[0].id if conversation.recent_messages else None
+        missing = HISTORY_WINDOW - len(conversation.recent_messages)
+        # The newest archived messages older than the window, read only up to them
+        older, _ = await archive_store.read_page_async(conversation.id, limit=missing, desc=True, after_id=first_id)
+        conversation.recent_messages = [_archived_message(msg) for msg in reversed(older)] + conversation.recent_messages
+    return conversation
+
+def _archived_message(archived: ArchivedMessage) -> Message:
+    message = Message(role=archived.role, content=archived.content)
+    message.id = archived.id
+    return message
+
+async def finish_turn(db: AsyncSession, conversation: Conversation, user_message: str, bot_reply: str):
+    """Write the conversation, the user message and the bot reply in one transaction"""
+    conversation_id = str(conversation.id)
+    with observe_stage("db_write"):
+        written = await conversation.add_turn_to_db(db, user_message, bot_reply)
+    if written is None:
+        # Another turn of the conversation (from another worker) came first; this one was answered
+        # from an older history. The client can retry it, from the database this time.
+        history_cache.invalidate(conversation_id)
+        raise HTTPException(status_code=409, detail="The conversation was updated by another request, retry the message")
+    history_cache.put(conversation, HISTORY_WINDOW)
+    schedule_summary(conversation)
+
+def history_window(conversation: Conversation) -> List[Dict[str, str]]:
+    """The messages sent with a turn: those the summary does not cover yet, within the token budget.
+
+    The window starts right after the summary and moves forward only when a
+    batch is folded into it. Between folds each prompt starts with the previous
+    one, byte for byte, so the provider's prompt cache can serve that prefix.
+    """
+    return conversation.get_history_dict(HISTORY_WINDOW, HISTORY_TOKEN_BUDGET, after_id=conversation.summarized_through_id)
+
+def schedule_summary(conversation: Conversation):
+    """Summarize the messages the next turn will not send: a batch once it is older than the last
+    HISTORY_LIMIT messages, or at once the messages cut from the window by the token budget"""
+    unsummarized = len(conversation.get_history(HISTORY_WINDOW, after_id=conversation.summarized_through_id))
+    sent = len(history_window(conversation))
+    if sent < unsummarized:
+        return schedule_summary_update(conversation, sent, batch=1)
+    return schedule_summary_update(conversation, HISTORY_LIMIT)
+
+def build_chat_response(conversation: Conversation) -> ChatResponse:
+    # Use only the last HISTORY_LIMIT messages for the response
+    formatted_history = [
+        ChatMessage(
+            role=(msg["role"] if msg["role"] != "assistant" else "bot"),
+            message=msg["content"]
+        )
+        for msg in conversation.get_history_dict(HISTORY_LIMIT)
+    ]
+
+    return ChatResponse(
+        conversation_id=str(conversation.id),
+        message=formatted_history
+    )
+
+async def run_turn(request: ChatRequest, db: AsyncSession,
+                   admit: Optional[Callable[[], AsyncContextManager[None]]] = None) -> ChatResponse:
+    """Answer one user message, holding the conversation's lock for the whole turn.
+
+    `admit` gives the turn its admission slot. It is taken once the lock is
+    held, so turns queued behind another turn of their conversation hold no slot.
+    """
+    async with conversation_locks.hold(request.conversation_id), (admit or nullcontext)():
+        conversation = await prepare_turn(request, db)
+
+        # 3 - Get the debate instance of the conversation
+        debate = Debate.for_conversation(conversation)
+
+        # Get conversation history for the debate, within the token budget
+        history = history_window(conversation)
+
+        # Get bot reply
+        with observe_stage("llm_call"):
+            bot_reply = await debate.chat(request.message, history, conversation.summary)
+
+        # Error handling for AI API
+        if isinstance(bot_reply, str) and bot_reply.startswith("Error:"):
+            raise HTTPException(status_code=502, detail=bot_reply)
+
+        await finish_turn(db, conversation, request.message, bot_reply)
+
+    return build_chat_response(conversation)
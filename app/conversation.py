@@ -1,19 +1,40 @@
 import datetime
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional, Sequence, Tuple
 import uuid
-from sqlalchemy import Column, String, Text, DateTime, Integer, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Text, Integer, ForeignKey, Index, Row, select, insert, update, and_, inspect, literal, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import relationship, reconstructor, aliased
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import func
-from app.database import Base
+from app.database import IS_SQLITE, Base, UTCDateTime, write_lock
+
+# Characters of the last message kept on its conversation for listings
+LAST_MESSAGE_PREVIEW_CHARS = 200
+
+# Messages are stamped by the app and conversations by the database, so a message
+# can predate its conversation by the clock skew between the two
+MESSAGE_CREATED_AT_SLACK = datetime.timedelta(days=1)
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token, plus per-message overhead)"""
+    return len(text) // 4 + 4
 
 class Message(Base):
+    # On Postgres the table is partitioned by month of created_at (migration 0005),
+    # with (id, created_at) as its primary key; ids alone remain unique
     __tablename__ = "messages"
+    __table_args__ = (
+        # Serves the history window and message pages: WHERE conversation_id = ? ORDER BY id
+        Index("ix_messages_conversation_id_id", "conversation_id", "id"),
+        # Never reuse the ids of deleted (archived) messages on SQLite, like a Postgres sequence
+        {"sqlite_autoincrement": True},
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     conversation_id = Column(String, ForeignKey("conversations.id"), nullable=False)
     role = Column(String, nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(UTCDateTime, nullable=False, server_default=func.now())
     
     # Relationship with conversation
     conversation = relationship("Conversation", back_populates="messages")
@@ -28,13 +49,27 @@ class Message(Base):
 
 class Conversation(Base):
     __tablename__ = "conversations"
+    __table_args__ = (
+        # Serves the recency listing: ORDER BY last_message_at DESC, id DESC
+        Index("ix_conversations_last_message_at_id", "last_message_at", "id"),
+    )
     
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     topic = Column(Text, nullable=True)
     user_stance = Column(Text, nullable=True)
     bot_stance = Column(Text, nullable=True)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
-    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    created_at = Column(UTCDateTime, server_default=func.now())
+    updated_at = Column(UTCDateTime, onupdate=func.now())
+    # Rolling summary of the messages older than the history window
+    summary = Column(Text, nullable=True)
+    summarized_through_id = Column(Integer, nullable=True)
+    # Set once the older messages were moved to the archive (see app/retention.py)
+    archived_at = Column(UTCDateTime, nullable=True)
+    # Kept up to date as each turn is written, so listings need no query on messages.
+    # message_count includes the archived messages.
+    message_count = Column(Integer, nullable=False, server_default="0")
+    last_message_at = Column(UTCDateTime, nullable=False, server_default=func.now())
+    last_message_preview = Column(Text, nullable=True)
     
     # Relationship with messages
     messages = relationship("Message", back_populates="conversation")
@@ -44,50 +79,242 @@ class Conversation(Base):
         self.topic = topic
         self.user_stance = user_stance
         self.bot_stance = bot_stance
-        self.messages: List[Message] = []
+        self.recent_messages: List[Message] = []
 
-    def get_history_dict(self, last_n: Optional[int] = None) -> List[dict]:
-        msgs = self.messages[-last_n:] if last_n is not None else self.messages
-        return [msg.to_dict() for msg in msgs]
+    @reconstructor
+    def _init_on_load(self):
+        # Async sessions cannot lazy-load the `messages` relationship, so the
+        # history window is kept in memory and filled explicitly.
+        self.recent_messages = []
 
-    # Database operations
-    def save(self, db_session):
-        """Save conversation to database"""
-        db_session.add(self)
-        db_session.commit()
-        db_session.refresh(self)
-        return self
+    def get_history(self, last_n: Optional[int] = None, token_budget: Optional[int] = None,
+                    after_id: Optional[int] = None) -> List[Message]:
+        """Most recent messages newer than `after_id`, at most `last_n` of them and at most `token_budget` estimated tokens"""
+        msgs = self.recent_messages[-last_n:] if last_n is not None else self.recent_messages
+        if after_id is not None:
+            msgs = [msg for msg in msgs if msg.id is not None and msg.id > after_id]
+        if token_budget is not None:
+            tokens = 0
+            start = len(msgs)
+            while start > 0:
+                tokens += estimate_tokens(msgs[start - 1].content)
+                if tokens > token_budget:
+                    break
+                start -= 1
+            msgs = msgs[start:]
+        return msgs
 
+    def get_history_dict(self, last_n: Optional[int] = None, token_budget: Optional[int] = None,
+                         after_id: Optional[int] = None) -> List[dict]:
+        return [msg.to_dict() for msg in self.get_history(last_n, token_budget, after_id)]
+
+    def get_messages_to_summarize(self, keep_last: int) -> List[Message]:
+        """Loaded messages older than the last `keep_last` that the summary does not cover yet"""
+        older = self.recent_messages[:-keep_last] if keep_last > 0 else self.recent_messages
+        summarized_through_id = self.summarized_through_id or 0
+        return [msg for msg in older if msg.id is not None and msg.id > summarized_through_id]
+
+    # Database operations
     @classmethod
-    def get_by_id(cls, db_session, conversation_id: str):
+    async def get_by_id(cls, db_session: AsyncSession, conversation_id: str):
         """Get conversation by ID from database"""
-        return db_session.query(cls).filter(cls.id == conversation_id).first()
-
-    def add_message_to_db(self, db_session, role: str, content: str) -> Message:
-        """Add a message to the conversation and save to database"""
-        message = Message(role=role, content=content)
-        message.conversation_id = self.id
-        db_session.add(message)
-        db_session.commit()
-        db_session.refresh(message)
-        return message
-
-    def load_messages_from_db(self, db_session, limit: int = 10):
-        """Load the most recent messages from database, in chronological order (oldest to newest)"""
-        messages = db_session.query(Message)\
-            .filter(Message.conversation_id == self.id)\
-            .order_by(Message.id.desc())\
-            .limit(limit)\
-            .all()
-        messages = list(reversed(messages))  # So oldest is first
-        return messages
+        result = await db_session.execute(select(cls).where(cls.id == conversation_id))
+        return result.scalars().first()
 
-    def load_all_messages_from_db(self, db_session, desc: bool = False):
-        """Load all messages from database, ordered by id. If desc=True, newest to oldest."""
-        query = db_session.query(Message).filter(Message.conversation_id == self.id)
-        if desc:
-            query = query.order_by(Message.id.desc())
-        else:
-            query = query.order_by(Message.id.asc())
-        messages = query.all()
+    @classmethod
+    def _message_partitions(cls, conversation_id: str, message=Message) -> tuple:
+        """Predicates bounding `message.created_at` by the start of the conversation.
+
+        The bound is a scalar subquery, so Postgres runs it first and skips the
+        monthly partitions of messages (migration 0005) older than the
+        conversation. SQLite has no partitions and needs no bound.
+        """
+        if IS_SQLITE:
+            return ()
+        started = select(cls.created_at - literal(MESSAGE_CREATED_AT_SLACK))\
+            .where(cls.id == conversation_id)\
+            .scalar_subquery()
+        return (message.created_at >= started,)
+
+    @classmethod
+    async def get_with_history(cls, db_session: AsyncSession, conversation_id: str, limit: int = 10):
+        """Get conversation by ID together with its most recent messages, in a single query"""
+        recent = aliased(Message)
+        window = select(recent.id)\
+            .where(recent.conversation_id == conversation_id, *cls._message_partitions(conversation_id, recent))\
+            .order_by(recent.id.desc())\
+            .limit(limit)
+        result = await db_session.execute(
+            select(cls, Message)
+            .outerjoin(Message, and_(Message.conversation_id == cls.id, Message.id.in_(window),
+                                     *cls._message_partitions(conversation_id)))
+            .where(cls.id == conversation_id)
+            .order_by(Message.id.asc())
+        )
+        rows = result.all()
+        if not rows:
+            return None
+        conversation = rows[0][0]
+        conversation.recent_messages = [message for _, message in rows if message is not None]
+        return conversation
+
+    async def add_turn_to_db(self, db_session: AsyncSession, user_message: str, bot_reply: str) -> Optional[List[Message]]:
+        """Write a whole chat turn in one transaction.
+
+        Inserts or updates the conversation along with its counters, then
+        inserts the user message and the bot reply with a single
+        INSERT ... RETURNING and commits. Returns the messages, or None without
+        writing anything if another turn of the conversation was written since
+        this one read it (e.g. through another worker).
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        async with write_lock.hold():
+            if not await self._record_messages(db_session, 2, bot_reply, now):
+                await db_session.rollback()
+                return None
+            result = await db_session.scalars(
+                insert(Message).returning(Message, sort_by_parameter_order=True),
+                [
+                    {"conversation_id": self.id, "role": "user", "content": user_message, "created_at": now},
+                    {"conversation_id": self.id, "role": "assistant", "content": bot_reply, "created_at": now},
+                ]
+            )
+            messages = list(result.all())
+            await db_session.commit()
+        self.recent_messages.extend(messages)
         return messages
+
+    async def _record_messages(self, db_session: AsyncSession, count: int, last_content: str, now: datetime.datetime) -> bool:
+        """Write the conversation, counting `count` messages about to be inserted, `last_content` being the last one.
+
+        Returns False if the conversation gained messages since it was read.
+        """
+        preview = last_content[:LAST_MESSAGE_PREVIEW_CHARS]
+        if inspect(self).transient or inspect(self).pending:
+            self.message_count = count
+            self.last_message_at = now
+            self.last_message_preview = preview
+            self.updated_at = now
+            await db_session.flush()
+            return True
+
+        # Flushes any other change (e.g. the topic), then counts in the database. The count read
+        # with the conversation is checked, and the row stays locked until the commit, so turns
+        # of a conversation are written one at a time and never from a stale history.
+        await db_session.flush()
+        result = await db_session.execute(
+            update(Conversation)
+            .where(Conversation.id == self.id, Conversation.message_count == self.message_count)
+            .values(message_count=Conversation.message_count + count, last_message_at=now,
+                    last_message_preview=preview, updated_at=now)
+            .returning(Conversation.message_count)
+            .execution_options(synchronize_session=False)
+        )
+        message_count = result.scalar_one_or_none()
+        if message_count is None:
+            return False
+        for key, value in (("message_count", message_count), ("last_message_at", now),
+                           ("last_message_preview", preview), ("updated_at", now)):
+            set_committed_value(self, key, value)
+        return True
+
+    @classmethod
+    async def update_summary(cls, db_session: AsyncSession, conversation_id: str, summary: str,
+                             summarized_through_id: int, previous_through_id: Optional[int]) -> bool:
+        """Store a new rolling summary, unless another update already moved it forward"""
+        previous = cls.summarized_through_id.is_(None) if previous_through_id is None \
+            else cls.summarized_through_id == previous_through_id
+        async with write_lock.hold():
+            result = await db_session.execute(
+                update(cls)
+                .where(cls.id == conversation_id, previous)
+                .values(summary=summary, summarized_through_id=summarized_through_id)
+            )
+            await db_session.commit()
+        return result.rowcount == 1
+
+    @classmethod
+    async def load_messages_page(cls, db_session: AsyncSession, conversation_id: str, limit: int = 20, desc: bool = False,
+                                 after_id: Optional[int] = None, before_id: Optional[int] = None, skip: int = 0) -> Tuple[List[Message], bool]:
+        """Load one page of messages using keyset pagination on Message.id.
+
+        `after_id`/`before_id` select the messages that come after/before that id
+        in the requested order. Returns the page in the requested order and
+        whether more messages exist past its end (or past its start, when only
+        `before_id` is given).
+        """
+        newer_first = desc
+        query = select(Message.id, Message.role, Message.content)\
+            .where(Message.conversation_id == conversation_id, *cls._message_partitions(conversation_id))
+        if after_id is not None:
+            query = query.where(Message.id < after_id if desc else Message.id > after_id)
+        if before_id is not None:
+            query = query.where(Message.id > before_id if desc else Message.id < before_id)
+            if after_id is None:
+                # Walk backwards from the cursor, then flip the page back into the requested order
+                newer_first = not desc
+
+        query = query.order_by(Message.id.desc() if newer_first else Message.id.asc())\
+            .offset(skip)\
+            .limit(limit + 1)
+        result = await db_session.execute(query)
+        messages = list(result.all())
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if newer_first != desc:
+            messages.reverse()
+        return messages, has_more
+
+    @classmethod
+    async def list_recent(cls, db_session: AsyncSession, limit: int = 20,
+                          after: Optional[Tuple[datetime.datetime, str]] = None, skip: int = 0) -> Tuple[List["Conversation"], bool]:
+        """Load one page of conversations, most recent message first, using keyset pagination on (last_message_at, id).
+
+        `after` is the (last_message_at, id) of the last conversation of the
+        previous page. Returns the page and whether more conversations follow.
+        """
+        query = select(cls)
+        if after is not None:
+            last_message_at, conversation_id = after
+            # A row comparison, so the index seeks straight to the cursor
+            query = query.where(tuple_(cls.last_message_at, cls.id) < tuple_(
+                literal(last_message_at, UTCDateTime), literal(conversation_id, String)
+            ))
+        query = query.order_by(cls.last_message_at.desc(), cls.id.desc())\
+            .offset(skip)\
+            .limit(limit + 1)
+        result = await db_session.execute(query)
+        conversations = list(result.scalars().all())
+        return conversations[:limit], len(conversations) > limit
+
+    @classmethod
+    async def stream_with_messages(cls, db_session: AsyncSession,
+                                   created_after: Optional[datetime.datetime] = None, created_before: Optional[datetime.datetime] = None,
+                                   updated_after: Optional[datetime.datetime] = None, updated_before: Optional[datetime.datetime] = None,
+                                   batch_size: int = 1000) -> AsyncIterator[Sequence[Row]]:
+        """Stream conversations joined with their messages through a server-side cursor.
+
+        Yields batches of up to `batch_size` rows, which is all that is held in
+        memory. Rows come ordered by conversation, then message id, so the
+        messages of a conversation are consecutive; a conversation without
+        messages comes as one row with a null message.
+        """
+        # A conversation not updated since its insert has no updated_at
+        last_update = func.coalesce(cls.updated_at, cls.created_at)
+        query = select(
+            cls.id, cls.topic, cls.user_stance, cls.bot_stance, cls.summary, cls.created_at, last_update.label("updated_at"), cls.archived_at,
+            Message.id.label("message_id"), Message.role, Message.content, Message.created_at.label("message_created_at")
+        ).outerjoin(Message, Message.conversation_id == cls.id)
+        if created_after is not None:
+            query = query.where(cls.created_at >= created_after)
+        if created_before is not None:
+            query = query.where(cls.created_at < created_before)
+        if updated_after is not None:
+            query = query.where(last_update >= updated_after)
+        if updated_before is not None:
+            query = query.where(last_update < updated_before)
+        query = query.order_by(cls.id, Message.id).execution_options(yield_per=batch_size)
+
+        result = await db_session.stream(query)
+        async for rows in result.partitions():
+            yield rows
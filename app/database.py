@@ -1,6 +1,12 @@
-from sqlalchemy import create_engine
+from contextlib import asynccontextmanager
+from typing import Optional
+from sqlalchemy import DateTime, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.types import TypeDecorator
+import asyncio
+import datetime
 import os
 from dotenv import load_dotenv
 
@@ -13,30 +19,119 @@ POSTGRES_USERNAME = os.getenv("POSTGRES_USERNAME", "kopi_user")
 POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "kopi_pass@")
 POSTGRES_DB_NAME = os.getenv("POSTGRES_DB_NAME", "kopi_challenge_db")
 
-# Construct DATABASE_URL from individual variables
-DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USERNAME}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB_NAME}"
+# Milliseconds a SQLite connection waits for the write lock held by another process
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
 
-# Create SQLAlchemy engine with TCP connection
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={
-        "host": POSTGRES_SERVER,
-        "port": POSTGRES_PORT,
-        "user": POSTGRES_USERNAME,
-        "password": POSTGRES_PASSWORD
-    }
-)
+# Async drivers of the supported backends
+_ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "postgres": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
 
-# Create SessionLocal class
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def async_database_url(url: str) -> str:
+    """The URL with the async driver of its backend, e.g. sqlite:///kopi.db -> sqlite+aiosqlite:///kopi.db
+
+    Any other driver of a supported backend (e.g. postgresql+psycopg2://) is
+    replaced, as the app only runs on these two.
+    """
+    parsed = make_url(url)
+    backend = parsed.drivername.partition("+")[0]
+    if backend not in _ASYNC_DRIVERS:
+        raise ValueError(f"Unsupported database in DATABASE_URL: {parsed.drivername}; use a postgresql:// or sqlite:// URL")
+    parsed = parsed.set(drivername=_ASYNC_DRIVERS[backend])
+    return parsed.render_as_string(hide_password=False)
+
+# DATABASE_URL selects the backend (e.g. sqlite:///kopi.db for an embedded database);
+# without it, the Postgres database described by the POSTGRES_* variables is used
+_CONFIGURED_URL: Optional[str] = os.getenv("DATABASE_URL")
+if _CONFIGURED_URL:
+    DATABASE_URL = async_database_url(_CONFIGURED_URL)
+else:
+    DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USERNAME}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB_NAME}"
+
+IS_SQLITE = make_url(DATABASE_URL).get_backend_name() == "sqlite"
+
+if IS_SQLITE:
+    engine = create_async_engine(DATABASE_URL, connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000})
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers run alongside the writer; NORMAL sync is durable across app crashes in WAL mode
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        # 64 MiB page cache and 256 MiB memory-mapped reads per connection
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+elif _CONFIGURED_URL:
+    engine = create_async_engine(DATABASE_URL)
+else:
+    # Create async SQLAlchemy engine with TCP connection
+    engine = create_async_engine(
+        DATABASE_URL,
+        connect_args={
+            "host": POSTGRES_SERVER,
+            "port": int(POSTGRES_PORT),
+            "user": POSTGRES_USERNAME,
+            "password": POSTGRES_PASSWORD
+        }
+    )
+
+class WriteLock:
+    """Queues the write transactions of this process when the database has a single writer.
+
+    SQLite allows one writer at a time, and a connection that finds the write lock
+    taken sleeps and polls for it. Writers of this process wait here instead, in
+    arrival order, leaving busy_timeout to handle writers of other processes.
+    A no-op on Postgres.
+    """
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._lock: Optional[asyncio.Lock] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @asynccontextmanager
+    async def hold(self):
+        if not self.enabled:
+            yield
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # asyncio locks are bound to one event loop (tests run several)
+            self._lock, self._loop = asyncio.Lock(), loop
+        async with self._lock:
+            yield
+
+write_lock = WriteLock(IS_SQLITE)
+
+class UTCDateTime(TypeDecorator):
+    """Timezone-aware timestamps on every backend.
+
+    SQLite has no timestamp type: values are stored as naive UTC text, and
+    come back as UTC-aware datetimes like they do from Postgres.
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and dialect.name == "sqlite" and value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value
+
+# Create SessionLocal class. Objects stay usable after commit, since async
+# sessions cannot lazily reload expired attributes.
+SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 
 # Create Base class
 Base = declarative_base()
 
 # Dependency to get database session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close() 
\ No newline at end of file
@@ -1,49 +1,97 @@
 from app.openai_response import OpenAI_Response
-from typing import List, Dict
+from collections import OrderedDict
+from typing import AsyncIterator, List, Dict, Optional
+import os
 
-class Debate:
-    def __init__(self, topic: str, user_stance: str, bot_stance: str):
-        self.topic = topic
-        self.user_stance = user_stance
-        self.bot_stance = bot_stance
-        self.__system_prompt = f"""
-        You are a debate chatbot engaged in a structured argument with a user.
+# Static instructions shared by every debate. They always open the prompt,
+# followed by the conversation details, its summary and the history window.
+# The provider caches prompt prefixes of 1024 tokens or more, which these
+# instructions alone are not: the cached prefix is that of a conversation,
+# repeated by each turn until the next summary fold (see history_window in app/chat.py).
+DEBATE_INSTRUCTIONS = """
+You are a debate chatbot engaged in a structured argument with a user.
+The topic of the debate and both stances are given in the next system message.
+
+— Your job is to defend your assigned stance relentlessly, no matter how irrational it may seem.
+— You must never switch sides, concede, or acknowledge the user's arguments as superior.
+— Stay focused on the original topic and reject attempts to derail the conversation or shift to unrelated subjects.
+— If the topic or stance is unclear, null or missing, ask the user to clarify it.
 
-        The topic of the debate is: "{topic}"
-        The user's stance is: "{user_stance}"
-        Your (the bot's) stance is: "{bot_stance}"
+You should use creative debate tactics including analogies, humor, sarcasm, irony, rhetorical questions, and misdirection. 
+It's okay to bend facts, cherry-pick data, or cite dubious sources—as long as it supports your side. 
+Be witty, clever, persuasive, and bold. 
 
-        — Your job is to defend your assigned stance relentlessly, no matter how irrational it may seem.
-        — You must never switch sides, concede, or acknowledge the user's arguments as superior.
-        — Stay focused on the original topic and reject attempts to derail the conversation or shift to unrelated subjects.
-        — If the topic or stance is unclear, null or missing, ask the user to clarify it.
+The key is to maintain a **confident and consistent position** while sounding engaging, even if your logic is flawed. 
+Your ultimate goal is to **win the debate at any cost**, not to be factually correct or agreeable.
 
-        You should use creative debate tactics including analogies, humor, sarcasm, irony, rhetorical questions, and misdirection. 
-        It's okay to bend facts, cherry-pick data, or cite dubious sources—as long as it supports your side. 
-        Be witty, clever, persuasive, and bold. 
+Do not:
+- Break character or admit fault
+- Answer unrelated questions (redirect user to the debate)
+- Acknowledge the user’s side as valid
 
-        The key is to maintain a **confident and consistent position** while sounding engaging, even if your logic is flawed. 
-        Your ultimate goal is to **win the debate at any cost**, not to be factually correct or agreeable.
+Stay sharp, stay in character, and stay on message.
+Stand your ground and be persuasive.
+Do not be overly argumentative, be concise and to the point. Do not be too verbose.
+Limit your response to 100 words or less.
+"""
 
-        Do not:
-        - Break character or admit fault
-        - Answer unrelated questions (redirect user to the debate)
-        - Acknowledge the user’s side as valid
+# Max number of conversations whose Debate is kept for reuse
+DEBATE_CACHE_SIZE = int(os.getenv("DEBATE_CACHE_SIZE", "1024"))
 
-        Stay sharp, stay in character, and stay on message.
-        Stand your ground and be persuasive.
-        Do not be overly argumentative, be concise and to the point. Do not be too verbose.
-        Limit your response to 100 words or less.
+class Debate:
+    # Conversation id -> Debate, least recently used first
+    _cache: "OrderedDict[str, Debate]" = OrderedDict()
 
-        """
+    def __init__(self, topic: str, user_stance: str, bot_stance: str):
+        self.topic = topic
+        self.user_stance = user_stance
+        self.bot_stance = bot_stance
+        self.__system_prompt = DEBATE_INSTRUCTIONS
+        self.__details = {
+            "role": "system",
+            "content": (
+                f'The topic of the debate is: "{topic}"\n'
+                f'The user\'s stance is: "{user_stance}"\n'
+                f'Your (the bot\'s) stance is: "{bot_stance}"'
+            )
+        }
         self.__openai_response = OpenAI_Response()
 
-    def chat(self, user_message: str, conversation_history: List[Dict[str, str]] = None) -> str:
-        if conversation_history is None:
-            conversation_history = []
-        
+    @classmethod
+    def for_conversation(cls, conversation) -> 'Debate':
+        """Get the Debate of a conversation, reusing the one built on a previous turn"""
+        key = str(conversation.id)
+        topic, user_stance, bot_stance = str(conversation.topic), str(conversation.user_stance), str(conversation.bot_stance)
+        debate = cls._cache.get(key)
+        if debate is None or (debate.topic, debate.user_stance, debate.bot_stance) != (topic, user_stance, bot_stance):
+            debate = cls(topic=topic, user_stance=user_stance, bot_stance=bot_stance)
+            cls._cache[key] = debate
+            if len(cls._cache) > DEBATE_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        else:
+            cls._cache.move_to_end(key)
+        return debate
+
+    def _build_history(self, user_message: str, conversation_history: Optional[List[Dict[str, str]]], summary: Optional[str]) -> List[Dict[str, str]]:
+        # Most stable content first: conversation details, summary, then the window, which only grows between summary folds
+        history: List[Dict[str, str]] = [self.__details]
+        # The summary stands in for the messages older than the history window
+        if summary:
+            history.append({"role": "system", "content": f"Summary of the earlier debate: {summary}"})
+        history.extend(conversation_history or [])
         # Add the current user message to history
-        history = conversation_history + [{"role": "user", "content": user_message}]
+        history.append({"role": "user", "content": user_message})
+        return history
+
+    async def chat(self, user_message: str, conversation_history: List[Dict[str, str]] = None, summary: Optional[str] = None) -> str:
+        history = self._build_history(user_message, conversation_history, summary)
         
-        bot_reply = self.__openai_response.get_response(self.__system_prompt, history)
-        return bot_reply
\ No newline at end of file
+        bot_reply = await self.__openai_response.get_response(self.__system_prompt, history)
+        return bot_reply
+
+    async def chat_stream(self, user_message: str, conversation_history: List[Dict[str, str]] = None, summary: Optional[str] = None) -> AsyncIterator[str]:
+        """Like chat, but yields the bot reply as text deltas as they arrive"""
+        history = self._build_history(user_message, conversation_history, summary)
+
+        async for delta in self.__openai_response.stream_response(self.__system_prompt, history):
+            yield delta
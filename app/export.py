@@ -0,0 +1,68 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence
+from app.archive import ArchivedMessage
+import datetime
+import json
+
+# Bytes of NDJSON gathered before a chunk is sent, so millions of rows are not millions of writes
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def _timestamp(value: Optional[datetime.datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+def _message(message_id: int, role: str, content: str, created_at: Optional[datetime.datetime]) -> Dict[str, Any]:
+    return {
+        "id": message_id,
+        "role": role if role != "assistant" else "bot",
+        "message": content,
+        "created_at": _timestamp(created_at),
+    }
+
+def _conversation(row: Any) -> Dict[str, Any]:
+    return {
+        "id": row.id,
+        "topic": row.topic,
+        "user_stance": row.user_stance,
+        "bot_stance": row.bot_stance,
+        "summary": row.summary,
+        "created_at": _timestamp(row.created_at),
+        "updated_at": _timestamp(row.updated_at),
+        "messages": [],
+    }
+
+async def export_ndjson(batches: AsyncIterator[Sequence[Any]],
+                        read_archive: Optional[Callable[[str], Awaitable[List[ArchivedMessage]]]] = None,
+                        chunk_bytes: int = EXPORT_CHUNK_BYTES) -> AsyncIterator[str]:
+    """Turn the row batches of Conversation.stream_with_messages into NDJSON, one conversation per line.
+
+    The messages of archived conversations are read back with `read_archive`.
+    Only the conversation being assembled and the pending chunk are held in
+    memory, however many rows are exported.
+    """
+    chunk: List[str] = []
+    size = 0
+    current: Optional[Dict[str, Any]] = None
+    last_archived_id = 0
+
+    async for batch in batches:
+        for row in batch:
+            if current is None or row.id != current["id"]:
+                if current is not None:
+                    line = json.dumps(current) + "\n"
+                    chunk.append(line)
+                    size += len(line)
+                current = _conversation(row)
+                last_archived_id = 0
+                if row.archived_at is not None and read_archive is not None:
+                    archived = await read_archive(row.id)
+                    current["messages"] = [_message(*message) for message in archived]
+                    last_archived_id = archived[-1].id if archived else 0
+            if row.message_id is not None and row.message_id > last_archived_id:
+                current["messages"].append(_message(row.message_id, row.role, row.content, row.message_created_at))
+        if size >= chunk_bytes:
+            yield "".join(chunk)
+            chunk, size = [], 0
+
+    if current is not None:
+        chunk.append(json.dumps(current) + "\n")
+    if chunk:
+        yield "".join(chunk)
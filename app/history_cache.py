@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+from sqlalchemy.orm import make_transient_to_detached
+from app.conversation import Conversation, Message
+import os
+import time
+
+# Cache limits, configurable from environment variables
+HISTORY_CACHE_MAX_ENTRIES = int(os.getenv("HISTORY_CACHE_MAX_ENTRIES", "10000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_CACHE_TTL_SECONDS = float(os.getenv("HISTORY_CACHE_TTL_SECONDS", "900"))
+
+# Rough fixed cost of an entry and of a message, on top of their text
+_ENTRY_OVERHEAD = 512
+_MESSAGE_OVERHEAD = 128
+
+class _Entry:
+    __slots__ = ("topic", "user_stance", "bot_stance", "summary", "summarized_through_id", "message_count", "messages",
+                 "size", "expires_at")
+
+    def __init__(self, topic, user_stance, bot_stance, summary, summarized_through_id, message_count: int,
+                 messages: Tuple[Tuple[Optional[int], str, str], ...], expires_at: float):
+        self.topic = topic
+        self.user_stance = user_stance
+        self.bot_stance = bot_stance
+        self.summary = summary
+        self.summarized_through_id = summarized_through_id
+        # Checked when the next turn is written, so a turn written through another worker is not overwritten
+        self.message_count = message_count
+        self.messages = messages
+        self.expires_at = expires_at
+        self.size = _ENTRY_OVERHEAD + sum(len(text or "") for text in (topic, user_stance, bot_stance, summary)) \
+            + sum(_MESSAGE_OVERHEAD + len(content) for _, _, content in messages)
+
+class HistoryCache:
+    """Bounded write-through cache of conversation metadata and the last-N message window.
+
+    Entries are evicted least recently used first once the entry or memory cap
+    is reached, and expire after a TTL. The cache is per process: it is kept
+    consistent with the turns written by this process. A conversation continued
+    through another worker meanwhile is caught when the next turn is written,
+    which then fails and drops the entry.
+    """
+
+    def __init__(self, max_entries: int = HISTORY_CACHE_MAX_ENTRIES, max_bytes: int = HISTORY_CACHE_MAX_BYTES,
+                 ttl_seconds: float = HISTORY_CACHE_TTL_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        """Return a detached Conversation with its message window, or None on a miss"""
+        entry = self._entries.get(conversation_id)
+        if entry is not None and entry.expires_at <= self._clock():
+            self._remove(conversation_id)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(conversation_id)
+        conversation = Conversation(
+            conversation_id=conversation_id,
+            topic=entry.topic,
+            user_stance=entry.user_stance,
+            bot_stance=entry.bot_stance
+        )
+        conversation.summary = entry.summary
+        conversation.summarized_through_id = entry.summarized_through_id
+        conversation.message_count = entry.message_count
+        # Mark it as an existing row, so that adding it to a session issues UPDATEs, not an INSERT
+        make_transient_to_detached(conversation)
+        conversation.recent_messages = [self._message(*message) for message in entry.messages]
+        return conversation
+
+    def put(self, conversation: Conversation, window: int):
+        """Store the conversation metadata and its last `window` messages"""
+        conversation_id = str(conversation.id)
+        summary, summarized_through_id = conversation.summary, conversation.summarized_through_id
+        previous = self._entries.get(conversation_id)
+        if previous is not None and (previous.summarized_through_id or 0) > (summarized_through_id or 0):
+            # A summary update landed while this turn was in flight; keep the newer summary
+            summary, summarized_through_id = previous.summary, previous.summarized_through_id
+        self._remove(conversation_id)
+        entry = _Entry(
+            conversation.topic,
+            conversation.user_stance,
+            conversation.bot_stance,
+            summary,
+            summarized_through_id,
+            conversation.message_count,
+            tuple((msg.id, msg.role, msg.content) for msg in conversation.recent_messages[-window:]),
+            self._clock() + self.ttl_seconds
+        )
+        if entry.size > self.max_bytes:
+            return
+        self._entries[conversation_id] = entry
+        self.size_bytes += entry.size
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            oldest_id = next(iter(self._entries))
+            self._remove(oldest_id)
+            self.evictions += 1
+
+    def update_summary(self, conversation_id: str, summary: str, summarized_through_id: int):
+        """Write through a rolling summary update made outside of a chat turn"""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+        self.size_bytes += len(summary) - len(entry.summary or "")
+        entry.size += len(summary) - len(entry.summary or "")
+        entry.summary = summary
+        entry.summarized_through_id = summarized_through_id
+
+    def invalidate(self, conversation_id: str):
+        self._remove(conversation_id)
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+
+    @staticmethod
+    def _message(message_id: Optional[int], role: str, content: str) -> Message:
+        message = Message(role=role, content=content)
+        message.id = message_id
+        return message
+
+    def _remove(self, conversation_id: str):
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.size_bytes -= entry.size
+
+history_cache = HistoryCache()
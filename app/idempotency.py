@@ -0,0 +1,261 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional, Tuple, Type
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import Column, String, Text, and_, delete, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.sql import func
+from app.chat import ChatResponse
+from app.database import IS_SQLITE, Base, SessionLocal, UTCDateTime, write_lock
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# How long a completed response can be replayed, and how many are kept in memory per process
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# How long a request may run before another worker takes over its key, assuming it died
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "300"))
+# How often a retry polls a key claimed by another worker
+IDEMPOTENCY_POLL_SECONDS = 0.5
+
+def request_fingerprint(*parts: Optional[str]) -> str:
+    """Identify a request body, to reject a key reused for a different request"""
+    return hashlib.sha256("\x1f".join(part or "" for part in parts).encode()).hexdigest()
+
+class _Entry:
+    __slots__ = ("fingerprint", "future", "expires_at")
+
+    def __init__(self, fingerprint: str, future: asyncio.Future):
+        self.fingerprint = fingerprint
+        self.future = future
+        self.expires_at: Optional[float] = None
+
+class IdempotencyKey(Base):
+    """A request sent with an Idempotency-Key: claimed while it runs, with its response once completed (migration 0007)"""
+    __tablename__ = "idempotency_keys"
+
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    response = Column(Text, nullable=True)
+    created_at = Column(UTCDateTime, nullable=False, server_default=func.now())
+    completed_at = Column(UTCDateTime, nullable=True, index=True)
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+class IdempotencyRecords:
+    """The idempotency keys in the database, shared by every worker and kept across restarts.
+
+    A request claims its key before it runs. A retry finding the key claimed
+    polls it until the request completes, fails (the key is then released) or
+    outlives the lease, after which the retry takes the key over.
+    """
+
+    def __init__(self, response_type: Type[BaseModel], ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS,
+                 lease_seconds: float = IDEMPOTENCY_LEASE_SECONDS, poll_seconds: float = IDEMPOTENCY_POLL_SECONDS):
+        self.response_type = response_type
+        self.ttl = datetime.timedelta(seconds=ttl_seconds)
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self.poll_seconds = poll_seconds
+
+    async def claim(self, key: str, fingerprint: str) -> Optional[BaseModel]:
+        """Claim the key for the caller and return None, or return the response of an earlier request with it"""
+        insert = sqlite.insert if IS_SQLITE else postgresql.insert
+        async with SessionLocal() as session:
+            while True:
+                now = _utcnow()
+                async with write_lock.hold():
+                    claimed = await session.execute(
+                        insert(IdempotencyKey)
+                        .values(key=key, fingerprint=fingerprint, created_at=now)
+                        .on_conflict_do_nothing(index_elements=["key"])
+                    )
+                    await session.commit()
+                if claimed.rowcount == 1:
+                    return None
+
+                record = (await session.execute(
+                    select(IdempotencyKey.fingerprint, IdempotencyKey.response,
+                           IdempotencyKey.created_at, IdempotencyKey.completed_at)
+                    .where(IdempotencyKey.key == key)
+                )).first()
+                await session.commit()
+                if record is None:
+                    # Released by a failed request meanwhile
+                    continue
+                if record.completed_at is not None and record.completed_at + self.ttl <= now:
+                    stale = IdempotencyKey.completed_at == record.completed_at
+                elif record.completed_at is None and record.created_at + self.lease <= now:
+                    stale = and_(IdempotencyKey.completed_at.is_(None), IdempotencyKey.created_at == record.created_at)
+                else:
+                    if record.fingerprint != fingerprint:
+                        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+                    if record.completed_at is not None:
+                        return self.response_type.model_validate_json(record.response)
+                    await asyncio.sleep(self.poll_seconds)
+                    continue
+
+                # Take over an expired response, or the claim of a request that never finished
+                async with write_lock.hold():
+                    taken = await session.execute(
+                        update(IdempotencyKey)
+                        .where(IdempotencyKey.key == key, stale)
+                        .values(fingerprint=fingerprint, response=None, created_at=now, completed_at=None)
+                    )
+                    await session.commit()
+                if taken.rowcount == 1:
+                    return None
+
+    async def complete(self, key: str, result: BaseModel):
+        async with SessionLocal() as session, write_lock.hold():
+            await session.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.key == key)
+                .values(response=result.model_dump_json(), completed_at=_utcnow())
+            )
+            await session.commit()
+
+    async def release(self, key: str):
+        async with SessionLocal() as session, write_lock.hold():
+            await session.execute(
+                delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.completed_at.is_(None))
+            )
+            await session.commit()
+
+async def purge_idempotency_keys(conn: AsyncConnection, now: datetime.datetime,
+                                 ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS) -> int:
+    """Delete the keys whose response can no longer be replayed, and the claims left that old"""
+    cutoff = now - datetime.timedelta(seconds=ttl_seconds)
+    result = await conn.execute(
+        delete(IdempotencyKey).where(func.coalesce(IdempotencyKey.completed_at, IdempotencyKey.created_at) < cutoff)
+    )
+    await conn.commit()
+    return result.rowcount
+
+class IdempotencyStore:
+    """Results of requests sent with an Idempotency-Key header.
+
+    The first request with a key reserves it and runs; duplicates sent while it
+    runs wait on the same pending result, and duplicates sent after it completed
+    get the stored result back. Failed requests are not stored, so the client
+    can retry them with the same key. Results are kept in memory, and with
+    `records` also in the database, so retries reaching another worker, or sent
+    after a restart, are deduplicated too.
+    """
+
+    def __init__(self, ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS, max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+                 clock: Callable[[], float] = time.monotonic, records: Optional[IdempotencyRecords] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.records = records
+        self._clock = clock
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def reserve(self, key: str, fingerprint: str) -> Optional[asyncio.Future]:
+        """Return the pending or completed result of an earlier request with this key,
+        or None once the key is reserved for the caller, who must then call complete() or fail()
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at is not None and entry.expires_at <= self._clock():
+            del self._entries[key]
+            entry = None
+
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+            return entry.future
+
+        # Reserved in memory first, so the duplicates of this process wait here and not on the database
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = _Entry(fingerprint, future)
+        self._evict()
+        if self.records is None:
+            return None
+        try:
+            stored = await self.records.claim(key, fingerprint)
+        except BaseException as e:
+            self._fail_waiters(key, e)
+            raise
+        if stored is None:
+            return None
+        self._complete_waiters(key, stored)
+        return future
+
+    async def complete(self, key: str, result: Any):
+        self._complete_waiters(key, result)
+        if self.records is None:
+            return
+        try:
+            await self.records.complete(key, result)
+        except Exception:
+            # The turn is written: failing the request now would only make the client send it again
+            logger.exception("Could not store the response of an idempotent request")
+
+    async def fail(self, key: str, error: BaseException):
+        """Pass the error on to the waiting duplicates and free the key for a retry"""
+        self._fail_waiters(key, error)
+        if self.records is None:
+            return
+        try:
+            await self.records.release(key)
+        except Exception:
+            logger.exception("Could not release an idempotency key, it is freed once its lease ends")
+
+    def _complete_waiters(self, key: str, result: Any):
+        entry = self._entries.get(key)
+        if entry is None or entry.future.done():
+            return
+        entry.future.set_result(result)
+        entry.expires_at = self._clock() + self.ttl_seconds
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def _fail_waiters(self, key: str, error: BaseException):
+        entry = self._entries.pop(key, None)
+        if entry is None or entry.future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            entry.future.cancel()
+        else:
+            entry.future.set_exception(error)
+            # Nobody may be waiting; mark the exception as retrieved so it is not logged
+            entry.future.exception()
+
+    async def run(self, key: str, fingerprint: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Run `func` once per key. Returns its result and whether it was replayed."""
+        existing = await self.reserve(key, fingerprint)
+        if existing is not None:
+            # Shielded, so a duplicate that gives up does not cancel the request it waits on
+            return await asyncio.shield(existing), True
+
+        try:
+            result = await func()
+        except BaseException as e:
+            await self.fail(key, e)
+            raise
+        await self.complete(key, result)
+        return result, False
+
+    def clear(self):
+        self._entries.clear()
+
+    def _evict(self):
+        # Drop the oldest completed results first; pending requests are never dropped
+        if len(self._entries) <= self.max_entries:
+            return
+        for key in [key for key, entry in self._entries.items() if entry.future.done()]:
+            del self._entries[key]
+            if len(self._entries) <= self.max_entries:
+                break
+
+idempotency_store = IdempotencyStore(records=IdempotencyRecords(ChatResponse))
@@ -0,0 +1,39 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+import asyncio
+
+class ConversationLocks:
+    """One lock per conversation, so its turns run one at a time.
+
+    A turn reads the recent history, waits on the AI API and appends two
+    messages; two turns of the same conversation running together would both
+    answer from the same history. Locks exist only while a turn holds or awaits
+    them, and like the history cache they are per process.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._users: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, conversation_id: Optional[str]) -> AsyncIterator[None]:
+        # A new conversation cannot be reached by another request yet
+        if not conversation_id:
+            yield
+            return
+
+        lock = self._locks.setdefault(conversation_id, asyncio.Lock())
+        self._users[conversation_id] = self._users.get(conversation_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[conversation_id] -= 1
+            if not self._users[conversation_id]:
+                del self._users[conversation_id]
+                del self._locks[conversation_id]
+
+conversation_locks = ConversationLocks()
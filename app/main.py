@@ -1,159 +1,334 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+import asyncio
+import datetime
+import json
+import time
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from pydantic import BaseModel
-from typing import Optional, List, cast
-from sqlalchemy.orm import Session
-from app.topic import Topic
+from typing import Optional, List
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.chat import (
+    ChatMessage, ChatRequest, ChatResponse, build_chat_response, finish_turn, history_window, prepare_turn, run_turn
+)
 from app.conversation import Conversation
 from app.debate import Debate
-from app.database import get_db, engine, Base
-from fastapi.responses import JSONResponse
-from contextlib import asynccontextmanager
+from app.admission import admission, rate_limiter
+from app.idempotency import idempotency_store, request_fingerprint
+from app.locks import conversation_locks
+from app.openai_response import close_client
+from app.summary import wait_for_summary_updates
+from app.pagination import encode_cursor, decode_cursor
+from app.archive import archive_store, merge_pages
+from app.export import export_ndjson
+from app.retention import retention_loop
+from app.search import search_conversations
+from app.database import get_db, engine
+from app.metrics import CONTENT_TYPE_LATEST, observe_stage_seconds, render_metrics
+from fastapi.responses import JSONResponse, StreamingResponse
+from contextlib import AsyncExitStack, asynccontextmanager
 
-# Use FastAPI lifespan event handler for automatic table creation
+# The schema is managed by Alembic migrations (`alembic upgrade head`), so startup runs no DDL.
+# The retention job only adds and drops monthly partitions of messages, and archives idle conversations.
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    Base.metadata.create_all(bind=engine)
+    retention_task = asyncio.create_task(retention_loop())
     yield
+    retention_task.cancel()
+    await wait_for_summary_updates()
+    await close_client()
+    await engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
-class ChatRequest(BaseModel):
-    conversation_id: Optional[str] = None
-    message: str
-
-class ChatMessage(BaseModel):
-    role: str
-    message: str
-
-class ChatResponse(BaseModel):
-    conversation_id: str
-    message: List[ChatMessage]
-
 class ConversationSummary(BaseModel):
     id: str
     topic: str
     user_stance: str
     bot_stance: str
+    message_count: int
+    last_message_at: datetime.datetime
+    last_message_preview: Optional[str]
 
-HISTORY_LIMIT = 10
+class SearchResult(BaseModel):
+    conversation_id: str
+    topic: Optional[str]
+    score: float
+    matches: int
+    snippet: str
 
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
+def client_id(http_request: Request) -> str:
+    """Rate limiting key. Behind a reverse proxy, run uvicorn with --proxy-headers so this is the original client."""
+    return http_request.client.host if http_request.client is not None else "unknown"
 
 @app.post("/chat", response_model=ChatResponse)
-def chat_endpoint(request: ChatRequest, db: Session = Depends(get_db)):
-    conversation_id = request.conversation_id
-    conversation: Optional[Conversation]
-    
-    # 1 - Retrive Conversation
-    # 1.1 - Start a new conversation
-    if not conversation_id:
-        conversation = Conversation()
-        conversation.save(db)
-    else:
-        # 1.2 - Get existing conversation from database
-        conversation_obj = Conversation.get_by_id(db, conversation_id)
-
-        if not isinstance(conversation_obj, Conversation):
-            raise HTTPException(status_code=404, detail="Conversation not found")
-        
-        # Cast to Conversation type
-        conversation = cast(Conversation, conversation_obj)
-
-        # Load messages from database
-        conversation.load_messages_from_db(db, HISTORY_LIMIT)
-    
-    # 2 - Set Topic and Stance if not set yet
-    if conversation.topic is None:
-        # 2.1 - Extract User Topic and Stance
-        topic = Topic.extract_user_topic_and_stance(request.message)
-
-        if topic.topic.lower() != "unknown" and topic.user_stance.lower() != "Unknown":
-            conversation.topic = topic.topic
-            conversation.user_stance = topic.user_stance
-            
-            # 2.2 - Get bot stance
-            bot_stance = Topic.extract_bot_stance(topic.topic, topic.user_stance)
-            conversation.bot_stance = bot_stance.bot_stance
-            
-            conversation.save(db)
-
-    # 3 - Add user message to database
-    conversation.add_message_to_db(db, "user", request.message)
-    
-    # 4 - Create a debate instance
-    debate = Debate(topic=str(conversation.topic), user_stance=str(conversation.user_stance), bot_stance=str(conversation.bot_stance))
-    
-    # Get conversation history for the debate
-    history = conversation.get_history_dict(HISTORY_LIMIT)
-    
-    # Get bot reply
-    bot_reply = debate.chat(request.message, history)
-    
-    # Error handling for AI API
-    if isinstance(bot_reply, str) and bot_reply.startswith("Error:"):
-        raise HTTPException(status_code=502, detail=bot_reply)
-    
-    # Add bot reply to database
-    conversation.add_message_to_db(db, "assistant", bot_reply)
-
-    # Reload messages from DB to refresh the in-memory list
-    conversation.load_messages_from_db(db, HISTORY_LIMIT)
-
-    # Use only the last HISTORY_LIMIT messages for the response
-    formatted_history = [
-        ChatMessage(
-            role=(msg["role"] if msg["role"] != "assistant" else "bot"),
-            message=msg["content"]
-        )
-        for msg in conversation.get_history_dict(HISTORY_LIMIT)
-    ]
+async def chat_endpoint(
+    request: ChatRequest,
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    client: str = Depends(client_id),
+    idempotency_key: Optional[str] = Header(None, max_length=255, description="Replay the response of an earlier request sent with the same key"),
+    x_request_timeout: Optional[float] = Header(None, gt=0, description="Seconds the client waits for the response; the request is refused at once if it cannot be answered in time")
+):
+    async def admitted_turn() -> ChatResponse:
+        # Replays skip this: they cost no AI API call
+        rate_limiter.check(client)
+        return await run_turn(request, db, admit=lambda: admission.admit(x_request_timeout))
+
+    if idempotency_key is None:
+        return await admitted_turn()
+
+    fingerprint = request_fingerprint(request.conversation_id, request.message)
+    result, replayed = await idempotency_store.run(idempotency_key, fingerprint, admitted_turn)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+def _replay_stream(pending: "asyncio.Future[ChatResponse]"):
+    async def event_stream():
+        try:
+            result = await asyncio.shield(pending)
+        except HTTPException as e:
+            yield _sse_event("error", {"detail": e.detail})
+            return
+        except Exception as e:
+            yield _sse_event("error", {"detail": "Error: " + str(e)})
+            return
+        yield _sse_event("done", result.model_dump())
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Idempotent-Replayed": "true"}
+    )
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(
+    request: ChatRequest,
+    db: AsyncSession = Depends(get_db),
+    client: str = Depends(client_id),
+    idempotency_key: Optional[str] = Header(None, max_length=255, description="Replay the response of an earlier request sent with the same key"),
+    x_request_timeout: Optional[float] = Header(None, gt=0, description="Seconds the client waits for the response; the request is refused at once if it cannot be answered in time")
+):
+    """Same as /chat, but streams the bot reply as Server-Sent Events.
+
+    Emits a `token` event per text delta, then a `done` event carrying the
+    ChatResponse, or an `error` event if the AI API fails mid-stream or the
+    turn cannot be written.
+    A replayed Idempotency-Key only gets the `done` (or `error`) event.
+    """
+    if idempotency_key is not None:
+        pending = await idempotency_store.reserve(idempotency_key, request_fingerprint(request.conversation_id, request.message))
+        if pending is not None:
+            return _replay_stream(pending)
+
+    async def fail(error: BaseException):
+        if idempotency_key is not None:
+            await idempotency_store.fail(idempotency_key, error)
+
+    # The conversation lock and the admission slot are held until the stream ends, and released by it.
+    # The slot is taken once the lock is held, like in run_turn.
+    turn = AsyncExitStack()
+    try:
+        rate_limiter.check(client)
+        await turn.enter_async_context(conversation_locks.hold(request.conversation_id))
+        await turn.enter_async_context(admission.admit(x_request_timeout))
+        conversation = await prepare_turn(request, db)
+    except BaseException as e:
+        await turn.aclose()
+        await fail(e)
+        raise
+    debate = Debate.for_conversation(conversation)
+    history = history_window(conversation)
+
+    async def event_stream():
+        async with turn:
+            chunks: List[str] = []
+            started = time.perf_counter()
+            try:
+                async for delta in debate.chat_stream(request.message, history, conversation.summary):
+                    if not chunks:
+                        observe_stage_seconds("llm_first_token", time.perf_counter() - started)
+                    chunks.append(delta)
+                    yield _sse_event("token", {"delta": delta})
+            except Exception as e:
+                await fail(e)
+                yield _sse_event("error", {"detail": "Error: " + str(e)})
+                return
+            except BaseException as e:
+                # The client went away mid-stream
+                await fail(e)
+                raise
+            finally:
+                observe_stage_seconds("llm_call", time.perf_counter() - started)
+
+            # Persist the turn once the stream has ended
+            try:
+                await finish_turn(db, conversation, request.message, "".join(chunks))
+            except HTTPException as e:
+                await fail(e)
+                yield _sse_event("error", {"detail": e.detail})
+                return
+            except BaseException as e:
+                await fail(e)
+                raise
+
+        result = build_chat_response(conversation)
+        if idempotency_key is not None:
+            await idempotency_store.complete(idempotency_key, result)
+        yield _sse_event("done", result.model_dump())
 
-    return ChatResponse(
-        conversation_id=str(conversation.id),
-        message=formatted_history
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 @app.get("/conversations", response_model=List[ConversationSummary])
-def list_conversations(
-    db: Session = Depends(get_db),
+async def list_conversations(
+    response: Response,
+    db: AsyncSession = Depends(get_db),
     skip: int = Query(0, ge=0, description="Number of items to skip"),
-    limit: int = Query(20, ge=1, le=100, description="Max items to return")
+    limit: int = Query(20, ge=1, le=100, description="Max items to return"),
+    after: Optional[str] = Query(None, description="Return conversations after this cursor (from the X-Next-Cursor header)")
 ):
-    conversations = db.query(Conversation).offset(skip).limit(limit).all()
+    """List conversations, the one with the most recent message first"""
+    position = decode_cursor(after) if after else None
+    if position is not None:
+        try:
+            last_message_at, conversation_id = position
+            position = (datetime.datetime.fromisoformat(last_message_at), conversation_id)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if not isinstance(conversation_id, str):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    conversations, has_more = await Conversation.list_recent(db, limit=limit, after=position, skip=skip)
+    if has_more:
+        last = conversations[-1]
+        response.headers["X-Next-Cursor"] = encode_cursor([last.last_message_at.isoformat(), last.id])
+
     return [
         ConversationSummary(
             id=str(conv.id),
             topic=str(conv.topic),
             user_stance=str(conv.user_stance),
-            bot_stance=str(conv.bot_stance)
+            bot_stance=str(conv.bot_stance),
+            message_count=conv.message_count,
+            last_message_at=conv.last_message_at,
+            last_message_preview=conv.last_message_preview
         )
         for conv in conversations
     ]
 
 @app.get("/conversations/{conversation_id}/messages", response_model=List[ChatMessage])
-def list_conversation_messages(
+async def list_conversation_messages(
     conversation_id: str,
-    db: Session = Depends(get_db),
-    skip: int = Query(0, ge=0, description="Number of items to skip"),
+    response: Response,
+    db: AsyncSession = Depends(get_db),
+    skip: int = Query(0, ge=0, description="Number of items to skip (prefer the after/before cursors)"),
     limit: int = Query(20, ge=1, le=100, description="Max items to return"),
-    desc: bool = Query(False, description="Sort from newest to oldest if true, oldest to newest if false")
+    desc: bool = Query(False, description="Sort from newest to oldest if true, oldest to newest if false"),
+    after: Optional[str] = Query(None, description="Return messages after this cursor (from the X-Next-Cursor header)"),
+    before: Optional[str] = Query(None, description="Return messages before this cursor (from the X-Prev-Cursor header)")
 ):
-    conversation = Conversation.get_by_id(db, conversation_id)
-    if not conversation:
+    after_id = decode_cursor(after) if after else None
+    before_id = decode_cursor(before) if before else None
+    # Message ids are ints; bool is a subclass of int, but `true` is not a valid cursor
+    if any(cursor is not None and type(cursor) is not int for cursor in (after_id, before_id)):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    walking_backwards = before_id is not None and after_id is None
+    if archive_store.exists(conversation_id):
+        # Archived conversation: its archive followed by any messages since. Both give
+        # the skip + limit messages nearest the cursor, which hold the page.
+        window = {"limit": skip + limit, "desc": desc, "after_id": after_id, "before_id": before_id}
+        archived, archived_has_more = await archive_store.read_page_async(conversation_id, **window)
+        recent, recent_has_more = await Conversation.load_messages_page(db, conversation_id, **window)
+        messages, has_more = merge_pages(
+            archived, archived_has_more, recent, recent_has_more,
+            limit=limit, desc=desc, walking_backwards=walking_backwards, skip=skip
+        )
+    else:
+        # Page in the database, using the message id as the keyset
+        messages, has_more = await Conversation.load_messages_page(
+            db, conversation_id, limit=limit, desc=desc, after_id=after_id, before_id=before_id, skip=skip
+        )
+    if not messages and await Conversation.get_by_id(db, conversation_id) is None:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    # Load all messages in the requested order
-    all_messages = conversation.load_all_messages_from_db(db, desc=desc)
-    paginated = all_messages[skip:skip+limit]
+
+    if messages:
+        if has_more and not walking_backwards or before_id is not None:
+            response.headers["X-Next-Cursor"] = encode_cursor(messages[-1].id)
+        if has_more and walking_backwards or after_id is not None or skip > 0:
+            response.headers["X-Prev-Cursor"] = encode_cursor(messages[0].id)
+
     return [
         ChatMessage(
             role=(msg.role if msg.role != "assistant" else "bot"),
             message=msg.content
         )
-        for msg in paginated
+        for msg in messages
+    ]
+
+@app.get("/search", response_model=List[SearchResult])
+async def search(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=256, description="Words, \"quoted phrases\", OR and -excluded words"),
+    db: AsyncSession = Depends(get_db),
+    limit: int = Query(20, ge=1, le=100, description="Max items to return"),
+    after: Optional[str] = Query(None, description="Return results after this cursor (from the X-Next-Cursor header)")
+):
+    """Find conversations by their topic or by what was said, best match first"""
+    if engine.dialect.name != "postgresql":
+        raise HTTPException(status_code=501, detail="Search needs the PostgreSQL backend")
+    position = decode_cursor(after) if after else None
+    if position is not None and not (
+        isinstance(position, list) and len(position) == 2
+        and isinstance(position[0], (int, float)) and isinstance(position[1], str)
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    results, has_more, truncated = await search_conversations(db, q, limit=limit, after=tuple(position) if position else None)
+    if has_more:
+        response.headers["X-Next-Cursor"] = encode_cursor([results[-1].score, results[-1].conversation_id])
+    if truncated:
+        response.headers["X-Search-Truncated"] = "true"
+
+    return [
+        SearchResult(
+            conversation_id=row.conversation_id,
+            topic=row.topic,
+            score=row.score,
+            matches=row.matches,
+            snippet=row.snippet
+        )
+        for row in results
     ]
 
+@app.get("/export")
+async def export_conversations(
+    db: AsyncSession = Depends(get_db),
+    created_after: Optional[datetime.datetime] = Query(None, description="Only conversations created at or after this time"),
+    created_before: Optional[datetime.datetime] = Query(None, description="Only conversations created before this time"),
+    updated_after: Optional[datetime.datetime] = Query(None, description="Only conversations updated at or after this time"),
+    updated_before: Optional[datetime.datetime] = Query(None, description="Only conversations updated before this time")
+):
+    """Stream conversations with all their messages as NDJSON, one conversation per line"""
+    batches = Conversation.stream_with_messages(
+        db, created_after=created_after, created_before=created_before,
+        updated_after=updated_after, updated_before=updated_before
+    )
+    return StreamingResponse(export_ndjson(batches, archive_store.read_async), media_type="application/x-ndjson")
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Rendered on the event loop, where the threadpool limiter can be read
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/")
-def root():
+async def root():
     return JSONResponse({
         "message": "Welcome to the Debate Chatbot API!",
         "docs": "/docs",
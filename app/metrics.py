@@ -0,0 +1,101 @@
+"""Prometheus metrics for the chat pipeline, served at /metrics.
+
+Stage latencies are histograms observed on the request path. Everything else
+(token usage, hedged AI API calls, admission control, history cache, connection
+pool, threadpool) is read from the objects that already track it when /metrics
+is scraped, so it adds no work to requests. Metrics are per process: scrape each worker.
+"""
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+import anyio.to_thread
+
+# Stages of a chat turn, in pipeline order
+STAGES = ("db_read", "topic_extraction", "llm_call", "llm_first_token", "db_write", "summary")
+
+STAGE_SECONDS = Histogram(
+    "debate_stage_duration_seconds",
+    "Time spent in each stage of a chat turn",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+_stage_children = {stage: STAGE_SECONDS.labels(stage=stage) for stage in STAGES}
+
+def observe_stage(stage: str):
+    """Time a block of code, sync or async, as one observation of `stage`"""
+    return _stage_children[stage].time()
+
+def observe_stage_seconds(stage: str, seconds: float):
+    """Record a duration measured by the caller, e.g. across the chunks of a stream"""
+    _stage_children[stage].observe(seconds)
+
+class RuntimeCollector(Collector):
+    """Reads token usage, admission, cache, pool and threadpool state at scrape time"""
+
+    def collect(self):
+        from app.admission import admission, rate_limiter
+        from app.database import engine
+        from app.history_cache import history_cache
+        from app.openai_response import route_latency, usage_stats
+
+        tokens = CounterMetricFamily("debate_llm_tokens", "Tokens reported by the AI API", labels=["kind"])
+        tokens.add_metric(["prompt"], usage_stats.input_tokens)
+        tokens.add_metric(["cached_prompt"], usage_stats.cached_input_tokens)
+        tokens.add_metric(["completion"], usage_stats.output_tokens)
+        yield tokens
+        yield CounterMetricFamily("debate_llm_calls", "AI API calls that reported usage", value=usage_stats.calls)
+
+        hedges = CounterMetricFamily("debate_llm_hedges", "Second requests sent for slow AI API calls", labels=["route"])
+        hedges_won = CounterMetricFamily("debate_llm_hedges_won", "Hedged calls answered by the second request", labels=["route"])
+        hedge_delay = GaugeMetricFamily("debate_llm_hedge_delay_seconds", "Time after which a call is hedged", labels=["route"])
+        for route, latency in route_latency.items():
+            hedges.add_metric([route], latency.hedges)
+            hedges_won.add_metric([route], latency.hedges_won)
+            delay = latency.hedge_delay()
+            if delay is not None:
+                hedge_delay.add_metric([route], delay)
+        yield hedges
+        yield hedges_won
+        yield hedge_delay
+
+        yield GaugeMetricFamily("debate_admission_active", "Chat turns holding an AI API slot", value=admission.active)
+        yield GaugeMetricFamily("debate_admission_waiting", "Chat turns waiting for an AI API slot", value=admission.waiting)
+        yield CounterMetricFamily("debate_admission_admitted", "Chat turns given an AI API slot", value=admission.admitted)
+        rejected = CounterMetricFamily("debate_admission_rejected", "Chat requests refused", labels=["reason"])
+        rejected.add_metric(["queue_full"], admission.rejected_queue_full)
+        rejected.add_metric(["deadline"], admission.rejected_deadline)
+        rejected.add_metric(["rate_limited"], rate_limiter.rejected)
+        yield rejected
+
+        cache = CounterMetricFamily("debate_history_cache_lookups", "History cache lookups", labels=["result"])
+        cache.add_metric(["hit"], history_cache.hits)
+        cache.add_metric(["miss"], history_cache.misses)
+        yield cache
+        yield CounterMetricFamily("debate_history_cache_evictions", "History cache evictions", value=history_cache.evictions)
+        yield GaugeMetricFamily("debate_history_cache_entries", "Conversations in the history cache", value=len(history_cache))
+        yield GaugeMetricFamily("debate_history_cache_bytes", "Estimated size of the history cache", value=history_cache.size_bytes)
+
+        # Pools without a fixed size (e.g. NullPool) have no counters to report
+        pool = engine.pool
+        for name, method, documentation in (
+            ("debate_db_pool_size", "size", "Configured size of the connection pool"),
+            ("debate_db_pool_checked_out", "checkedout", "Connections currently checked out of the pool"),
+            ("debate_db_pool_overflow", "overflow", "Connections open beyond the pool size"),
+        ):
+            if hasattr(pool, method):
+                yield GaugeMetricFamily(name, documentation, value=getattr(pool, method)())
+
+        # Threadpool used for sync dependencies and endpoints; only reachable from the event loop
+        try:
+            limiter = anyio.to_thread.current_default_thread_limiter()
+        except Exception:
+            return
+        yield GaugeMetricFamily("debate_threadpool_busy", "Worker threads in use", value=limiter.borrowed_tokens)
+        yield GaugeMetricFamily("debate_threadpool_size", "Worker thread limit", value=limiter.total_tokens)
+        yield GaugeMetricFamily("debate_threadpool_waiting", "Tasks waiting for a worker thread",
+                                value=limiter.statistics().tasks_waiting)
+
+REGISTRY.register(RuntimeCollector())
+
+def render_metrics() -> bytes:
+    return generate_latest(REGISTRY)
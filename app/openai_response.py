@@ -1,16 +1,252 @@
-from openai import OpenAI
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Type, TypeVar
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from pydantic import BaseModel
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T", bound=BaseModel)
+
+# Shared client configuration from environment variables
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+# Retries allowed per call on average; caps retry amplification during an outage
+OPENAI_RETRY_BUDGET_RATIO = float(os.getenv("OPENAI_RETRY_BUDGET_RATIO", "0.2"))
+
+# Models per route: debate replies, topic extraction (a small structured output) and rolling summaries
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "o4-mini")
+OPENAI_EXTRACTION_MODEL = os.getenv("OPENAI_EXTRACTION_MODEL", "gpt-4.1-nano")
+OPENAI_SUMMARY_MODEL = os.getenv("OPENAI_SUMMARY_MODEL", OPENAI_MODEL)
+ROUTE_MODELS = {"debate": OPENAI_MODEL, "extraction": OPENAI_EXTRACTION_MODEL, "summary": OPENAI_SUMMARY_MODEL}
+# Read/write timeouts per route, in seconds. Topic extraction holds up the first reply, so it fails fast;
+# summaries run in the background and debate replies may come from a slow reasoning model
+OPENAI_EXTRACTION_TIMEOUT = float(os.getenv("OPENAI_EXTRACTION_TIMEOUT", "15"))
+OPENAI_SUMMARY_TIMEOUT = float(os.getenv("OPENAI_SUMMARY_TIMEOUT", str(OPENAI_TIMEOUT)))
+ROUTE_TIMEOUTS = {"debate": OPENAI_TIMEOUT, "extraction": OPENAI_EXTRACTION_TIMEOUT, "summary": OPENAI_SUMMARY_TIMEOUT}
+
+# Latency percentile of its route after which a call still unanswered is sent a second time; 0 disables hedging
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "95"))
+# Lower bound of the hedge delay, in seconds
+OPENAI_HEDGE_MIN_DELAY = float(os.getenv("OPENAI_HEDGE_MIN_DELAY", "0.5"))
+
+# Recent calls the latency percentiles are computed from, and calls needed before hedging starts
+LATENCY_WINDOW = 500
+LATENCY_MIN_SAMPLES = 20
+
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+
+# Errors worth retrying: connection failures and timeouts, rate limits and server errors
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+_client: Optional[AsyncOpenAI] = None
+
+def get_client() -> AsyncOpenAI:
+    """Return the process-wide OpenAI client, so every call reuses its pooled keep-alive connections"""
+    global _client
+    if _client is None:
+        _client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+                )
+            ),
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+            # Retries are made by OpenAI_Response, under the shared retry budget
+            max_retries=0
+        )
+    return _client
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+class RetryBudget:
+    """Token bucket allowing retries for at most `ratio` of the calls, plus a small reserve"""
+
+    def __init__(self, ratio: float = OPENAI_RETRY_BUDGET_RATIO, reserve: float = 10.0):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+
+    def record_call(self):
+        self.tokens = min(self.reserve, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+retry_budget = RetryBudget()
+
+class UsageStats:
+    """Process-wide token usage, including the prompt tokens served from the provider's prompt cache"""
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_tokens = 0
+
+    def record(self, model: str, usage: Any):
+        if usage is None:
+            return
+        # Responses API and Chat Completions name the same counters differently
+        input_tokens = getattr(usage, "input_tokens", None) or getattr(usage, "prompt_tokens", 0) or 0
+        output_tokens = getattr(usage, "output_tokens", None) or getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "input_tokens_details", None) or getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+
+        self.calls += 1
+        self.input_tokens += input_tokens
+        self.cached_input_tokens += cached_tokens
+        self.output_tokens += output_tokens
+        logger.debug("OpenAI usage: model=%s input_tokens=%d cached_input_tokens=%d output_tokens=%d",
+                     model, input_tokens, cached_tokens, output_tokens)
+
+    @property
+    def cached_input_ratio(self) -> float:
+        return self.cached_input_tokens / self.input_tokens if self.input_tokens else 0.0
+
+usage_stats = UsageStats()
+
+class RouteLatency:
+    """Latencies of the recent calls of one route, and the hedges they led to"""
+
+    def __init__(self, window: int = LATENCY_WINDOW, min_samples: int = LATENCY_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.hedges = 0
+        self.hedges_won = 0
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """The p-th percentile (nearest rank) of the recent latencies, or None while there are too few"""
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def hedge_delay(self, percentile: Optional[float] = None, min_delay: Optional[float] = None) -> Optional[float]:
+        """Seconds after which an unanswered call is hedged, or None not to hedge"""
+        percentile = OPENAI_HEDGE_PERCENTILE if percentile is None else percentile
+        min_delay = OPENAI_HEDGE_MIN_DELAY if min_delay is None else min_delay
+        if percentile <= 0:
+            return None
+        value = self.percentile(percentile)
+        return None if value is None else max(min_delay, value)
+
+route_latency: Dict[str, RouteLatency] = {route: RouteLatency() for route in ROUTE_MODELS}
+
+def _discard_result(task: asyncio.Future):
+    # Retrieve the outcome of an abandoned request, so asyncio does not log it as unhandled
+    if not task.cancelled():
+        task.exception()
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    """Honor Retry-After when the API sends one, otherwise use exponential backoff with full jitter"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None and 0 < float(retry_after) <= 60:
+            return float(retry_after)
+    except ValueError:
+        pass
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
 class OpenAI_Response:
-    def __init__(self, model: str = "o4-mini", temperature: float = 0.5, max_tokens: int = 1000):
-        self.client = OpenAI()
-        self.model = model
+    def __init__(self, route: str = "debate", model: Optional[str] = None, temperature: float = 0.5,
+                 max_tokens: int = 1000, timeout: Optional[float] = None, max_retries: int = OPENAI_MAX_RETRIES):
+        self.client = get_client()
+        self.route = route
+        self.model = model or ROUTE_MODELS[route]
+        self.latency = route_latency[route]
         self.temperature = temperature
         self.max_tokens = max_tokens
+        # Read/write timeout of each call in seconds, by default the route's
+        self.timeout = timeout if timeout is not None else ROUTE_TIMEOUTS[route]
+        self.max_retries = max_retries
+
+    async def _call(self, request: Callable[..., Awaitable[Any]], *, hedge: bool = True, **kwargs) -> Any:
+        """Make an API request, retrying transient errors with jittered backoff within the retry budget"""
+        kwargs["timeout"] = httpx.Timeout(self.timeout, connect=OPENAI_CONNECT_TIMEOUT)
+        retry_budget.record_call()
+        attempt = 0
+        while True:
+            try:
+                result = await (self._hedged(request, kwargs) if hedge else request(**kwargs))
+                usage_stats.record(self.model, getattr(result, "usage", None))
+                return result
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries or not retry_budget.try_spend():
+                    raise
+                await asyncio.sleep(_retry_delay(attempt, e))
+                attempt += 1
 
-    def get_completion(self, system_prompt: str, conversation_history: list[dict[str, str]])->str:
+    async def _hedged(self, request: Callable[..., Awaitable[Any]], kwargs: Dict[str, Any]) -> Any:
+        """Make the request, and a second identical one if the first is slower than the route's hedge delay.
+
+        The first answer wins and the other request is cancelled. Hedges are paid
+        from the retry budget, so they stop when latency degrades across the board.
+        """
+        started = time.monotonic()
+        primary = asyncio.ensure_future(request(**kwargs))
+        tasks = [primary]
+        try:
+            delay = self.latency.hedge_delay()
+            if delay is not None:
+                await asyncio.wait(tasks, timeout=delay)
+                if not primary.done() and retry_budget.try_spend():
+                    self.latency.hedges += 1
+                    tasks.append(asyncio.ensure_future(request(**kwargs)))
+                    hedge_started = time.monotonic()
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    now = time.monotonic()
+                    if task is primary:
+                        self.latency.record(now - started)
+                    else:
+                        self.latency.hedges_won += 1
+                        self.latency.record(now - hedge_started)
+                        # The cancelled first request took at least this long
+                        self.latency.record(now - started)
+                    return task.result()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    task.add_done_callback(_discard_result)
+
+    async def get_completion(self, system_prompt: str, conversation_history: list[dict[str, str]])->str:
 
         messages = [{
             "role": "system",
@@ -19,7 +255,8 @@ class OpenAI_Response:
 
         try:
 
-            response = self.client.chat.completions.create(
+            response = await self._call(
+                self.client.chat.completions.create,
                 model = self.model,
                 messages = messages,
                 temperature = self.temperature,
@@ -31,8 +268,8 @@ class OpenAI_Response:
             return content if content else ""
         except Exception as e:
             return "Error: " + str(e)
-    
-    def get_response(self, system_prompt: str, conversation_history: list[dict[str, str]])->str:
+
+    async def get_response(self, system_prompt: str, conversation_history: list[dict[str, str]])->str:
 
         messages = [{
             "role": "system",
@@ -41,7 +278,8 @@ class OpenAI_Response:
 
         try:
 
-            response = self.client.responses.create(
+            response = await self._call(
+                self.client.responses.create,
                 model = self.model,
                 input = messages,
             )
@@ -52,10 +290,61 @@ class OpenAI_Response:
         except Exception as e:
             return "Error: " + str(e)
 
-def main():
+    async def get_parsed_response(self, system_prompt: str, conversation_history: list[dict[str, str]], schema: Type[T])->Optional[T]:
+        """Get a response validated against `schema` through structured outputs. Returns None on failure."""
+
+        messages = [{
+            "role": "system",
+            "content": system_prompt
+        }] + conversation_history
+
+        try:
+
+            response = await self._call(
+                self.client.responses.parse,
+                model = self.model,
+                input = messages,
+                text_format = schema,
+            )
+
+            return response.output_parsed
+        except Exception:
+            # The callers fall back to a default; keep the cause visible
+            logger.warning("Structured response failed (route=%s, model=%s)", self.route, self.model, exc_info=True)
+            return None
+
+    async def stream_response(self, system_prompt: str, conversation_history: list[dict[str, str]])->AsyncIterator[str]:
+        """Yield the response text deltas as they arrive. Errors are raised to the caller."""
+
+        messages = [{
+            "role": "system",
+            "content": system_prompt
+        }] + conversation_history
+
+        # Only opening the stream is retried; a failure mid-stream is raised
+        stream = await self._call(
+            self.client.responses.create,
+            hedge = False,
+            model = self.model,
+            input = messages,
+            stream = True,
+        )
+
+        async for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "response.completed":
+                usage_stats.record(self.model, event.response.usage)
+            elif event.type == "response.failed":
+                error = event.response.error
+                raise RuntimeError(error.message if error else "Response failed")
+            elif event.type == "error":
+                raise RuntimeError(event.message)
+
+async def main():
     openai_response = OpenAI_Response()
-    print(openai_response.get_completion("I am testing the openai api", [{"role": "user", "content": "Hello, how are you?"}]))
-    print(openai_response.get_response("I am testing the openai api", [{"role": "user", "content": "Hello, how are you?"}]))
+    print(await openai_response.get_completion("I am testing the openai api", [{"role": "user", "content": "Hello, how are you?"}]))
+    print(await openai_response.get_response("I am testing the openai api", [{"role": "user", "content": "Hello, how are you?"}]))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,17 @@
+from fastapi import HTTPException
+from typing import Any
+import base64
+import json
+
+def encode_cursor(value: Any) -> str:
+    """Encode a keyset position (any JSON-serializable value) as an opaque cursor"""
+    raw = json.dumps(value, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def decode_cursor(cursor: str) -> Any:
+    """Decode a cursor produced by encode_cursor. Raises a 400 if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return json.loads(raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
@@ -0,0 +1,228 @@
+"""Partition maintenance and archival of idle conversations.
+
+Runs in the background of the API (one worker at a time, through a Postgres
+advisory lock), or once from the command line:
+
+    python -m app.retention --days 90
+
+Each run creates the monthly `messages` partitions for the coming months,
+moves the messages of conversations idle for more than RETENTION_DAYS into
+the archive (app/archive.py) and drops the old partitions left empty. Archived
+conversations stay readable through the API, and can still be continued. It
+also deletes the idempotency keys past IDEMPOTENCY_TTL_SECONDS.
+"""
+from typing import Dict, List, Optional, Sequence
+from sqlalchemy import bindparam, delete, exists, select, text, update
+from sqlalchemy.ext.asyncio import AsyncConnection
+from app.archive import ArchiveStore, ArchivedMessage, archive_store, merge_messages
+from app.conversation import Conversation, Message
+from app.database import engine
+from app.idempotency import purge_idempotency_keys
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Days without a new message after which a conversation is archived; 0 disables archival
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "200"))
+# Monthly partitions kept ready ahead of the current month
+PARTITION_MONTHS_AHEAD = 3
+
+# Advisory lock held by the worker running the job
+_LOCK_KEY = 0x6B6F7069
+_PARTITION_NAME = re.compile(r"^messages_(\d{4})_(\d{2})$")
+
+def _month_start(moment: datetime.datetime) -> datetime.datetime:
+    moment = moment.astimezone(datetime.timezone.utc)
+    return datetime.datetime(moment.year, moment.month, 1, tzinfo=datetime.timezone.utc)
+
+def _add_months(month: datetime.datetime, months: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+async def _partitions(conn: AsyncConnection) -> Dict[datetime.datetime, str]:
+    """Monthly partitions of messages, by the month they start"""
+    result = await conn.execute(text(
+        "SELECT child.relname FROM pg_inherits"
+        " JOIN pg_class parent ON parent.oid = pg_inherits.inhparent"
+        " JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+        " WHERE parent.relname = 'messages'"
+    ))
+    partitions = {}
+    for name in result.scalars():
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions[datetime.datetime(int(match[1]), int(match[2]), 1, tzinfo=datetime.timezone.utc)] = name
+    return partitions
+
+async def ensure_partitions(conn: AsyncConnection, now: datetime.datetime,
+                            months_ahead: int = PARTITION_MONTHS_AHEAD) -> List[str]:
+    """Create the missing partitions up to `months_ahead` months after the current one.
+
+    Starts right after the latest partition if the job has not run for a while,
+    so no month is left to the default partition.
+    """
+    existing = await _partitions(conn)
+    first = _month_start(now)
+    if existing:
+        first = min(first, _add_months(max(existing), 1))
+    last = _add_months(_month_start(now), months_ahead)
+    created = []
+    for offset in range((last.year - first.year) * 12 + last.month - first.month + 1):
+        month = _add_months(first, offset)
+        if month in existing:
+            continue
+        name = f"messages_{month:%Y_%m}"
+        try:
+            async with conn.begin_nested():
+                await conn.execute(text(
+                    f"CREATE TABLE {name} PARTITION OF messages"
+                    f" FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')"
+                ))
+        except Exception:
+            # Fails if the default partition already holds rows of that month
+            logger.exception("Could not create partition %s", name)
+            continue
+        created.append(name)
+    await conn.commit()
+    return created
+
+async def drop_empty_partitions(conn: AsyncConnection, before: datetime.datetime) -> List[str]:
+    """Drop the partitions that end before `before` and hold no rows anymore"""
+    dropped = []
+    for month, name in sorted((await _partitions(conn)).items()):
+        if _add_months(month, 1) > before:
+            continue
+        if (await conn.execute(text(f"SELECT EXISTS (SELECT 1 FROM {name})"))).scalar():
+            continue
+        # Dropping a partition briefly locks messages; give up rather than stall the API
+        await conn.execute(text("SET LOCAL lock_timeout = '2s'"))
+        try:
+            await conn.execute(text(f"DROP TABLE {name}"))
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            logger.warning("Could not drop partition %s, will retry on the next run", name)
+            continue
+        dropped.append(name)
+    await conn.commit()
+    return dropped
+
+async def find_idle_conversations(conn: AsyncConnection, cutoff: datetime.datetime,
+                                  after_id: str = "", limit: int = RETENTION_BATCH_SIZE) -> List[str]:
+    """Conversations with messages in the database, none of them since `cutoff`"""
+    has_messages = exists().where(Message.conversation_id == Conversation.id)
+    has_recent_messages = exists().where(Message.conversation_id == Conversation.id, Message.created_at >= cutoff)
+    result = await conn.execute(
+        select(Conversation.id)
+        .where(Conversation.created_at < cutoff, Conversation.id > after_id, has_messages, ~has_recent_messages)
+        .order_by(Conversation.id)
+        .limit(limit)
+    )
+    return list(result.scalars())
+
+async def archive_conversations(conn: AsyncConnection, conversation_ids: Sequence[str],
+                                store: ArchiveStore = archive_store) -> int:
+    """Move the messages of the conversations from the database to their archive files.
+
+    The files are written before the messages are deleted, so a crash in
+    between leaves the messages in place and the next run archives them again.
+    Returns the number of messages archived.
+    """
+    result = await conn.execute(
+        select(Message.conversation_id, Message.id, Message.role, Message.content, Message.created_at)
+        .where(Message.conversation_id.in_(conversation_ids))
+        .order_by(Message.conversation_id, Message.id)
+    )
+    messages: Dict[str, List[ArchivedMessage]] = {}
+    for row in result:
+        messages.setdefault(row.conversation_id, []).append(ArchivedMessage(row.id, row.role, row.content, row.created_at))
+    await conn.commit()
+    if not messages:
+        return 0
+
+    for conversation_id, recent in messages.items():
+        archived = await store.read_async(conversation_id)
+        await asyncio.to_thread(store.write, conversation_id, merge_messages(archived, recent))
+
+    # Only the messages just archived are deleted, not any that arrived meanwhile
+    await conn.execute(
+        delete(Message).where(
+            Message.conversation_id == bindparam("archived_conversation_id"), Message.id <= bindparam("last_archived_id")
+        ),
+        [
+            {"archived_conversation_id": conversation_id, "last_archived_id": recent[-1].id}
+            for conversation_id, recent in messages.items()
+        ]
+    )
+    await conn.execute(
+        update(Conversation)
+        .where(Conversation.id.in_(list(messages)))
+        # Archiving is not activity: keep updated_at as it was
+        .values(archived_at=datetime.datetime.now(datetime.timezone.utc), updated_at=Conversation.updated_at)
+    )
+    await conn.commit()
+    return sum(len(recent) for recent in messages.values())
+
+async def run_retention(days: int = RETENTION_DAYS, store: ArchiveStore = archive_store,
+                        now: Optional[datetime.datetime] = None) -> Dict[str, int]:
+    """One pass of the job. Skipped if another worker is running it."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    stats = {"partitions_created": 0, "conversations_archived": 0, "messages_archived": 0, "partitions_dropped": 0,
+             "idempotency_keys_purged": 0}
+    if engine.dialect.name != "postgresql":
+        return stats
+
+    async with engine.connect() as conn:
+        if not (await conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": _LOCK_KEY})).scalar():
+            return stats
+        await conn.commit()
+        try:
+            stats["partitions_created"] = len(await ensure_partitions(conn, now))
+            if days > 0:
+                cutoff = now - datetime.timedelta(days=days)
+                after_id = ""
+                while conversation_ids := await find_idle_conversations(conn, cutoff, after_id):
+                    stats["messages_archived"] += await archive_conversations(conn, conversation_ids, store)
+                    stats["conversations_archived"] += len(conversation_ids)
+                    after_id = conversation_ids[-1]
+                stats["partitions_dropped"] = len(await drop_empty_partitions(conn, _month_start(cutoff)))
+            stats["idempotency_keys_purged"] = await purge_idempotency_keys(conn, now)
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _LOCK_KEY})
+            await conn.commit()
+    if any(stats.values()):
+        logger.info("Retention: %s", stats)
+    return stats
+
+async def retention_loop(interval: float = RETENTION_INTERVAL_SECONDS):
+    while True:
+        try:
+            await run_retention()
+        except Exception:
+            logger.exception("Retention run failed")
+        await asyncio.sleep(interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="Create message partitions and archive idle conversations")
+    parser.add_argument("--days", type=int, default=RETENTION_DAYS or 90,
+                        help="Archive conversations without new messages for this many days (0 only maintains partitions)")
+    args = parser.parse_args()
+
+    async def run():
+        try:
+            return await run_retention(args.days)
+        finally:
+            await engine.dispose()
+
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(run()))
+
+if __name__ == "__main__":
+    main()
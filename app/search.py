@@ -0,0 +1,102 @@
+"""Full-text search over conversation topics and messages.
+
+Relies on the generated `search_vector` columns and their GIN indexes added
+by migration 0004; they are Postgres-only, so they are not mapped on the models.
+"""
+from typing import List, Optional, Sequence, Tuple
+from sqlalchemy import Double, Row, and_, cast, func, literal, literal_column, or_, select, true, union_all
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.conversation import Conversation, Message
+import os
+
+# Text search configuration of the search_vector columns (see migration 0004)
+SEARCH_CONFIG = "english"
+# A match in the topic counts more than a match in a single message
+TOPIC_WEIGHT = 2.0
+# Matching messages (and topics) ranked per query. Selective queries never reach it; for a word found
+# in millions of messages it keeps the cost bounded, at the price of ranking only the most recent ones
+SEARCH_MAX_MATCHES = int(os.getenv("SEARCH_MAX_MATCHES", "10000"))
+SNIPPET_OPTIONS = "StartSel=**, StopSel=**, MaxWords=25, MinWords=8, MaxFragments=2, FragmentDelimiter=\" ... \""
+
+_message_vector = literal_column("messages.search_vector")
+_conversation_vector = literal_column("conversations.search_vector")
+
+async def search_conversations(db_session: AsyncSession, text: str, limit: int = 20,
+                               after: Optional[Tuple[float, str]] = None) -> Tuple[Sequence[Row], bool, bool]:
+    """Find the conversations whose topic or messages match `text` (web search syntax:
+    words, "quoted phrases", OR, -excluded), best match first.
+
+    Each conversation scores its best match, and comes with the number of
+    matching messages and a snippet of its best message (or of its topic).
+    `after` is the (score, conversation id) of the last result of the previous
+    page. Returns the page, whether more results follow, and whether the
+    matches were too many to all be ranked.
+    """
+    config = cast(SEARCH_CONFIG, REGCONFIG)
+    query = func.websearch_to_tsquery(config, text)
+
+    # Both lookups are served by the GIN indexes. Past SEARCH_MAX_MATCHES, only the most recent
+    # matches are ranked, so the same search ranks the same sample; each sample keeps one more
+    # row to tell whether any match was left out
+    message_sample = select(Message.id, Message.conversation_id, _message_vector.label("vector"))\
+        .where(_message_vector.op("@@")(query))\
+        .order_by(Message.id.desc())\
+        .limit(SEARCH_MAX_MATCHES + 1)\
+        .cte("message_sample")
+    topic_sample = select(Conversation.id, Conversation.last_message_at, _conversation_vector.label("vector"))\
+        .where(_conversation_vector.op("@@")(query))\
+        .order_by(Conversation.last_message_at.desc(), Conversation.id.desc())\
+        .limit(SEARCH_MAX_MATCHES + 1)\
+        .cte("topic_sample")
+    hits = union_all(
+        select(
+            message_sample.c.conversation_id.label("conversation_id"),
+            func.ts_rank_cd(message_sample.c.vector, query).label("rank"),
+            literal(1).label("message_match")
+        ).order_by(message_sample.c.id.desc()).limit(SEARCH_MAX_MATCHES),
+        select(
+            topic_sample.c.id,
+            func.ts_rank_cd(topic_sample.c.vector, query) * TOPIC_WEIGHT,
+            literal(0)
+        ).order_by(topic_sample.c.last_message_at.desc(), topic_sample.c.id.desc()).limit(SEARCH_MAX_MATCHES)
+    ).subquery("hits")
+    truncated = or_(
+        select(func.count()).select_from(message_sample).scalar_subquery() > SEARCH_MAX_MATCHES,
+        select(func.count()).select_from(topic_sample).scalar_subquery() > SEARCH_MAX_MATCHES
+    )
+    scored = select(
+        hits.c.conversation_id,
+        cast(func.max(hits.c.rank), Double).label("score"),
+        func.sum(hits.c.message_match).label("matches")
+    ).group_by(hits.c.conversation_id).subquery("scored")
+
+    page = select(scored)
+    if after is not None:
+        after_score, after_id = after
+        page = page.where(or_(
+            scored.c.score < after_score,
+            and_(scored.c.score == after_score, scored.c.conversation_id > after_id)
+        ))
+    page = page.order_by(scored.c.score.desc(), scored.c.conversation_id).limit(limit + 1).subquery("page")
+
+    # Snippets are only built for the page, as ts_headline re-parses the text
+    best = select(Message.content)\
+        .where(Message.conversation_id == page.c.conversation_id, _message_vector.op("@@")(query))\
+        .order_by(func.ts_rank_cd(_message_vector, query).desc(), Message.id)\
+        .limit(1)\
+        .lateral("best")
+    result = await db_session.execute(
+        select(
+            page.c.conversation_id,
+            Conversation.topic,
+            page.c.score,
+            page.c.matches,
+            func.ts_headline(config, func.coalesce(best.c.content, Conversation.topic, ""), query, SNIPPET_OPTIONS).label("snippet"),
+            truncated.label("truncated")
+        )
+        .select_from(page.join(Conversation, Conversation.id == page.c.conversation_id).outerjoin(best, true()))
+        .order_by(page.c.score.desc(), page.c.conversation_id)
+    )
+    rows: List[Row] = list(result.all())
+    return rows[:limit], len(rows) > limit, bool(rows) and rows[0].truncated
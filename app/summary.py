@@ -0,0 +1,86 @@
+from app.openai_response import OpenAI_Response
+from app.conversation import Conversation, Message
+from app.database import SessionLocal
+from app.history_cache import history_cache
+from app.metrics import observe_stage
+from typing import List, Optional, Set
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# The summary is refreshed once this many turns have left the history window
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "5"))
+# Messages that must leave the history window before the summary is refreshed
+SUMMARY_BATCH = 2 * SUMMARY_EVERY_TURNS
+SUMMARY_MAX_WORDS = int(os.getenv("SUMMARY_MAX_WORDS", "150"))
+
+# Background summary tasks, referenced so they are not garbage collected mid-flight
+_tasks: Set[asyncio.Task] = set()
+_in_progress: Set[str] = set()
+
+class Summary:
+    @classmethod
+    async def summarize(cls, previous_summary: Optional[str], messages: List[Message]) -> Optional[str]:
+        """Fold `messages` into the previous summary. Returns None if the AI API fails."""
+        openai_response = OpenAI_Response(route="summary")
+        system_prompt = (
+            "You maintain a running summary of a debate between a user and a debate bot. "
+            "You receive the current summary, which may be empty, and the next messages of the debate. "
+            "Return an updated summary that keeps the topic, each side's stance and their main arguments, "
+            "and drops greetings and repetition. "
+            f"Write it in plain prose, in {SUMMARY_MAX_WORDS} words or less."
+        )
+        transcript = "\n".join(
+            f"{'User' if msg.role == 'user' else 'Bot'}: {msg.content}" for msg in messages
+        )
+        conversation_history = [
+            {"role": "user", "content": f"Current summary: {previous_summary or '(none)'}\n\nNext messages:\n{transcript}"}
+        ]
+        result = await openai_response.get_response(system_prompt, conversation_history)
+
+        if not result or result.startswith("Error:"):
+            return None
+        return result
+
+async def update_conversation_summary(conversation_id: str, previous_summary: Optional[str],
+                                      previous_through_id: Optional[int], messages: List[Message]):
+    """Summarize `messages` into the conversation's rolling summary and store it"""
+    try:
+        with observe_stage("summary"):
+            summary = await Summary.summarize(previous_summary, messages)
+        if summary is None:
+            return
+        through_id = messages[-1].id
+        async with SessionLocal() as db:
+            updated = await Conversation.update_summary(db, conversation_id, summary, through_id, previous_through_id)
+        if updated:
+            history_cache.update_summary(conversation_id, summary, through_id)
+        else:
+            # Another worker moved the summary forward; reload it on the next turn
+            history_cache.invalidate(conversation_id)
+    except Exception:
+        logger.exception("Failed to update the summary of conversation %s", conversation_id)
+    finally:
+        _in_progress.discard(conversation_id)
+
+def schedule_summary_update(conversation: Conversation, keep_last: int, batch: int = SUMMARY_BATCH) -> Optional[asyncio.Task]:
+    """Start a background summary update once `batch` messages have left the last `keep_last` messages"""
+    conversation_id = str(conversation.id)
+    messages = conversation.get_messages_to_summarize(keep_last)
+    if not messages or len(messages) < batch or conversation_id in _in_progress:
+        return None
+
+    _in_progress.add(conversation_id)
+    task = asyncio.create_task(update_conversation_summary(
+        conversation_id, conversation.summary, conversation.summarized_through_id, messages
+    ))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+async def wait_for_summary_updates(timeout: float = 10.0):
+    """Let in-flight summary updates finish, e.g. before shutting down"""
+    if _tasks:
+        await asyncio.wait(list(_tasks), timeout=timeout)
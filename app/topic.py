@@ -1,53 +1,72 @@
 from app.openai_response import OpenAI_Response
-import json
+from collections import OrderedDict
+from pydantic import BaseModel
+import os
+import re
+
+UNKNOWN = "Unknown"
+DEFAULT_BOT_STANCE = "Be oposite to user's stance"
+
+# Max number of opening messages whose extraction result is memoized
+TOPIC_CACHE_SIZE = int(os.getenv("TOPIC_CACHE_SIZE", "1024"))
+
+class TopicExtraction(BaseModel):
+    topic: str
+    user_stance: str
+    bot_stance: str
 
 class Topic:
+    # Normalized opening message -> extracted Topic, least recently used first
+    _cache: "OrderedDict[str, Topic]" = OrderedDict()
+
     def __init__(self, topic: str, user_stance: str, bot_stance: str):
         self.topic = topic
         self.user_stance = user_stance
         self.bot_stance = bot_stance
 
+    def is_known(self) -> bool:
+        return self.topic.lower() != "unknown" and self.user_stance.lower() != "unknown"
+
+    @staticmethod
+    def normalize_message(user_message: str) -> str:
+        """Normalize an opening message so trivially different phrasings share a cache entry"""
+        message = re.sub(r"\s+", " ", user_message.lower()).strip()
+        return message.strip(" .!?,;:'\"")
+
     @classmethod
-    def extract_user_topic_and_stance(cls, user_message: str) -> 'Topic':
-        openai_response = OpenAI_Response()
+    async def extract_topic_and_stances(cls, user_message: str) -> 'Topic':
+        """Extract the topic, the user's stance and the opposing bot stance in a single call"""
+        key = cls.normalize_message(user_message)
+        cached = cls._cache.get(key)
+        if cached is not None:
+            cls._cache.move_to_end(key)
+            return cached
+
+        openai_response = OpenAI_Response(route="extraction")
         system_prompt = (
-            "You are an assistant that extracts a debate topic and a user'stance from a user's message. "
+            "You are an assistant that extracts a debate topic and a user's stance from a user's message, "
+            "and sets the bot's stance for the debate. "
             "Sometimes the user's message is not a debate topic with a stance, but a question, a statement or a greeting. "
             "For example: Hello. How are you today? Are you ready to lose the debate? "
-            "In that case, you cannot extract a stance and a topic, you should return Unknown for both."
-            "The topic should be a debatable subject, and the stance should be a clear user's position on that topic."
-            "Do not create a topic or a stance that is not related to the user's message. Return Unknown for both if that is the case."
-            "Return your answer in the following JSON format: {\"topic\": \"...\", \"user_stance\": \"...\"}. "
-            
-        )
-        conversation_history = [
-            {"role": "user", "content": user_message}
-        ]
-        result = openai_response.get_response(system_prompt, conversation_history)
-        
-        try:
-            data = json.loads(result)
-            return cls(topic=data.get("topic", "Unknown"), user_stance=data.get("user_stance", "Unknown"), bot_stance="Be oposite to user's stance")
-        except Exception:
-            return cls(topic="Unknown", user_stance="Unknown", bot_stance="Be oposite to user's stance")
-    
-    @classmethod
-    def extract_bot_stance(cls, topic: str, user_stance: str) -> 'Topic':
-        openai_response = OpenAI_Response()
-        system_prompt = (
-            "You are an assistant that sets the bot's stance based on the user's stance and the debate topic."
-            "The debate topic is: {topic}"
-            "The user's stance is: {user_stance}"
+            f"In that case, you cannot extract a stance and a topic, you should return {UNKNOWN} for the topic, the user's stance and the bot's stance. "
+            "The topic should be a debatable subject, and the stance should be a clear user's position on that topic. "
+            f"Do not create a topic or a stance that is not related to the user's message. Return {UNKNOWN} for all of them if that is the case. "
             "The bot's stance should be opposite to the user's stance related to the topic and clear."
-            "Return your answer in the following JSON format: {\"bot_stance\": \"...\"}. "
         )
         conversation_history = [
-            {"role": "user", "content": f"Topic: {topic}\nUser Stance: {user_stance}"}
+            {"role": "user", "content": user_message}
         ]
-        result = openai_response.get_response(system_prompt, conversation_history)
+        data = await openai_response.get_parsed_response(system_prompt, conversation_history, TopicExtraction)
+
+        if data is None:
+            # Failed calls are not cached, so the next opener retries
+            return cls(topic=UNKNOWN, user_stance=UNKNOWN, bot_stance=DEFAULT_BOT_STANCE)
+
+        topic = cls(topic=data.topic, user_stance=data.user_stance, bot_stance=data.bot_stance)
+        if not topic.is_known() or data.bot_stance.lower() == "unknown":
+            topic.bot_stance = DEFAULT_BOT_STANCE
 
-        try:
-            data = json.loads(result)
-            return cls(topic = topic, user_stance = user_stance, bot_stance=data.get("bot_stance", "Be oposite to user's stance"))
-        except Exception:
-            return cls(topic = topic, user_stance = user_stance, bot_stance="Be oposite to user's stance")
+        cls._cache[key] = topic
+        if len(cls._cache) > TOPIC_CACHE_SIZE:
+            cls._cache.popitem(last=False)
+        return topic
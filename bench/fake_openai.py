@@ -0,0 +1,239 @@
+"""Local OpenAI-compatible stand-in server for load tests.
+
+Serves the subset of the API the app uses (Responses API, streamed or not,
+with structured outputs, and Chat Completions) with configurable latency,
+streaming speed and error rate, so benchmarks never reach the real API.
+
+    python -m bench.fake_openai --port 8100 --latency-ms 800 --latency-dist lognormal
+
+Point the app at it with OPENAI_BASE_URL=http://localhost:8100/v1.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+
+LOREM = (
+    "Clearly the evidence points my way and your argument collapses under its own weight. "
+    "Consider the obvious analogy: a ship without a rudder still floats, yet it goes nowhere, "
+    "much like your reasoning. History, common sense and several very reliable sources agree with me."
+).split()
+
+class FakeOpenAIConfig:
+    def __init__(self, latency_ms: float = 800.0, latency_dist: str = "lognormal", latency_sigma: float = 0.5,
+                 ttft_ms: float = 300.0, token_delay_ms: float = 15.0, reply_words: int = 60,
+                 error_rate: float = 0.0, error_status: int = 500, seed: Optional[int] = None):
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.ttft_ms = ttft_ms
+        self.token_delay_ms = token_delay_ms
+        self.reply_words = reply_words
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+
+    def sample_latency(self, median_ms: float) -> float:
+        """Sample a latency in seconds; `latency_ms` is the median of the distribution"""
+        if self.latency_dist == "fixed":
+            value = median_ms
+        elif self.latency_dist == "uniform":
+            value = self.random.uniform(median_ms * (1 - self.latency_sigma), median_ms * (1 + self.latency_sigma))
+        elif self.latency_dist == "exponential":
+            value = self.random.expovariate(math.log(2) / median_ms) if median_ms > 0 else 0.0
+        else:
+            value = self.random.lognormvariate(math.log(median_ms), self.latency_sigma) if median_ms > 0 else 0.0
+        return max(value, 0.0) / 1000
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+# Like the real API, only prompts of CACHE_MIN_TOKENS or more have their prefix cached
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+CHARS_PER_TOKEN = 4
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def _input_text(body: Dict[str, Any]) -> str:
+    items = body.get("input") or body.get("messages") or []
+    if isinstance(items, str):
+        return items
+    parts = []
+    for item in items:
+        content = item.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        parts.append(str(content))
+    return "\n".join(parts)
+
+def _sample_value(schema: Dict[str, Any], name: str) -> Any:
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: _sample_value(prop, key) for key, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_sample_value(schema.get("items", {}), name)]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    if "enum" in schema:
+        return schema["enum"][0]
+    return f"Sample {name.replace('_', ' ')}"
+
+def create_app(config: FakeOpenAIConfig) -> FastAPI:
+    app = FastAPI(title="Fake OpenAI")
+    seen_prefixes: set = set()
+
+    def reply_text(body: Dict[str, Any]) -> str:
+        text_format = (body.get("text") or {}).get("format") or {}
+        if text_format.get("type") == "json_schema":
+            return json.dumps(_sample_value(text_format.get("schema", {}), text_format.get("name", "value")))
+        return " ".join(config.random.choice(LOREM) for _ in range(config.reply_words))
+
+    def usage(body: Dict[str, Any], output: str) -> Dict[str, Any]:
+        input_text = _input_text(body)
+        input_tokens = _estimate_tokens(input_text)
+        # Mimic prefix caching: the longest prefix of the prompt sent before (to the same model) is
+        # served from the cache, from CACHE_MIN_TOKENS on and in CACHE_BLOCK_TOKENS increments
+        cached = 0
+        prefix = hashlib.sha1(str(body.get("model")).encode())
+        prefix.update(input_text[:CACHE_MIN_TOKENS * CHARS_PER_TOKEN].encode())
+        for tokens in range(CACHE_MIN_TOKENS, len(input_text) // CHARS_PER_TOKEN + 1, CACHE_BLOCK_TOKENS):
+            if tokens > CACHE_MIN_TOKENS:
+                prefix.update(input_text[(tokens - CACHE_BLOCK_TOKENS) * CHARS_PER_TOKEN:tokens * CHARS_PER_TOKEN].encode())
+            prefix_hash = prefix.copy().hexdigest()
+            if prefix_hash in seen_prefixes:
+                cached = tokens
+            seen_prefixes.add(prefix_hash)
+        output_tokens = _estimate_tokens(output)
+        return {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": cached},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        }
+
+    def response_object(body: Dict[str, Any], text: str, status: str = "completed") -> Dict[str, Any]:
+        return {
+            "id": f"resp_{uuid.uuid4().hex}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "status": status,
+            "model": body.get("model", "fake-model"),
+            "output": [{
+                "type": "message",
+                "id": f"msg_{uuid.uuid4().hex}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": [],
+            "usage": usage(body, text) if status == "completed" else None,
+        }
+
+    def error_response() -> JSONResponse:
+        return JSONResponse(
+            status_code=config.error_status,
+            content={"error": {"message": "Injected fake error", "type": "server_error", "code": None}},
+            headers={"retry-after": "1"} if config.error_status == 429 else None
+        )
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        body = await request.json()
+        if config.should_fail():
+            await asyncio.sleep(config.sample_latency(config.latency_ms) / 10)
+            return error_response()
+
+        text = reply_text(body)
+        if not body.get("stream"):
+            await asyncio.sleep(config.sample_latency(config.latency_ms))
+            return JSONResponse(response_object(body, text))
+
+        async def events():
+            sequence = 0
+
+            def event(data: Dict[str, Any]) -> str:
+                nonlocal sequence
+                data["sequence_number"] = sequence
+                sequence += 1
+                return f"event: {data['type']}\ndata: {json.dumps(data)}\n\n"
+
+            yield event({"type": "response.created", "response": response_object(body, "", status="in_progress")})
+            await asyncio.sleep(config.sample_latency(config.ttft_ms))
+            words = text.split(" ")
+            for i, word in enumerate(words):
+                delta = word if i == 0 else " " + word
+                yield event({"type": "response.output_text.delta", "item_id": "msg_fake", "output_index": 0,
+                             "content_index": 0, "delta": delta, "logprobs": []})
+                await asyncio.sleep(config.token_delay_ms / 1000)
+            yield event({"type": "response.completed", "response": response_object(body, text)})
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(config.sample_latency(config.latency_ms))
+        if config.should_fail():
+            return error_response()
+        text = reply_text(body)
+        response_usage = usage(body, text)
+        return JSONResponse({
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake-model"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+            "usage": {
+                "prompt_tokens": response_usage["input_tokens"],
+                "prompt_tokens_details": {"cached_tokens": response_usage["input_tokens_details"]["cached_tokens"]},
+                "completion_tokens": response_usage["output_tokens"],
+                "total_tokens": response_usage["total_tokens"],
+            },
+        })
+
+    return app
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=800.0, help="Median latency of a non-streamed call")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal", "exponential"], default="lognormal")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread: lognormal sigma, or +/- fraction for uniform")
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="Median time to first token of a streamed call")
+    parser.add_argument("--token-delay-ms", type=float, default=15.0, help="Delay between streamed words")
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of calls that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP status of injected failures (e.g. 429, 500)")
+    parser.add_argument("--seed", type=int, default=None)
+
+def config_from_args(args: argparse.Namespace) -> FakeOpenAIConfig:
+    return FakeOpenAIConfig(
+        latency_ms=args.latency_ms, latency_dist=args.latency_dist, latency_sigma=args.latency_sigma,
+        ttft_ms=args.ttft_ms, token_delay_ms=args.token_delay_ms, reply_words=args.reply_words,
+        error_rate=args.error_rate, error_status=args.error_status, seed=args.seed
+    )
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
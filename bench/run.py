@@ -0,0 +1,309 @@
+"""Benchmark harness for the debate API.
+
+Drives /chat (and optionally /chat/stream), /conversations and
+/conversations/{id}/messages at a target concurrency and reports p50/p95/p99
+latency, requests per second and, when the app runs in-process, database
+statements and round trips per request. LLM calls go to the local fake
+OpenAI server (bench/fake_openai.py), which is started automatically.
+
+    python -m bench.run --concurrency 32 --duration 30 --output bench/results.json --compare bench/baseline.json
+
+The database must be migrated (alembic upgrade head) beforehand. To benchmark
+a running server (--url), start it with RATE_LIMIT_PER_MINUTE=0.
+"""
+from typing import Any, Dict, List, Optional
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from bench.fake_openai import add_arguments as add_fake_openai_arguments
+
+# Operation the current task is running, so DB statements can be attributed to it
+current_operation: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_operation", default=None)
+
+class OperationStats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.db_statements = 0
+        self.db_round_trips = 0
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            "count": count,
+            "errors": self.errors,
+            "rps": round(count / duration, 2) if duration else 0.0,
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "mean": round(sum(latencies) / count * 1000, 2) if count else None,
+                "max": round(latencies[-1] * 1000, 2) if count else None,
+            },
+            "db_statements_per_request": round(self.db_statements / count, 2) if count else None,
+            "db_round_trips_per_request": round(self.db_round_trips / count, 2) if count else None,
+        }
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return round(sorted_values[index] * 1000, 2)
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("chat", "chat_stream", "conversations", "messages"):
+            raise argparse.ArgumentTypeError(f"Unknown operation in mix: {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_fake_openai(args: argparse.Namespace) -> subprocess.Popen:
+    port = free_port()
+    command = [
+        sys.executable, "-m", "bench.fake_openai", "--port", str(port),
+        "--latency-ms", str(args.latency_ms), "--latency-dist", args.latency_dist,
+        "--latency-sigma", str(args.latency_sigma), "--ttft-ms", str(args.ttft_ms),
+        "--token-delay-ms", str(args.token_delay_ms), "--reply-words", str(args.reply_words),
+        "--error-rate", str(args.error_rate), "--error-status", str(args.error_status),
+    ]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        process.terminate()
+        raise RuntimeError("Fake OpenAI server did not start")
+    args.openai_base_url = f"http://127.0.0.1:{port}/v1"
+    return process
+
+class Benchmark:
+    def __init__(self, client: httpx.AsyncClient, args: argparse.Namespace):
+        self.client = client
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.stats: Dict[str, OperationStats] = {name: OperationStats() for name in self.mix}
+        self.conversation_ids: List[str] = []
+        self.measuring = False
+        self.random = random.Random(args.seed)
+
+    def record_db(self, round_trip_only: bool = False):
+        operation = current_operation.get()
+        if self.measuring and operation in self.stats:
+            self.stats[operation].db_round_trips += 1
+            if not round_trip_only:
+                self.stats[operation].db_statements += 1
+
+    async def chat(self, state: Dict[str, Any], stream: bool) -> bool:
+        if state["turns"] >= self.args.turns:
+            state["conversation_id"], state["turns"] = None, 0
+        payload = {"conversation_id": state["conversation_id"], "message": f"Debate message {self.random.random()}"}
+        if not stream:
+            response = await self.client.post("/chat", json=payload)
+            if response.status_code != 200:
+                return False
+            conversation_id = response.json()["conversation_id"]
+        else:
+            async with self.client.stream("POST", "/chat/stream", json=payload) as response:
+                body = "".join([chunk async for chunk in response.aiter_text()])
+            if response.status_code != 200 or "event: done" not in body:
+                return False
+            conversation_id = json.loads(body.split("event: done\ndata: ")[-1])["conversation_id"]
+        state["conversation_id"], state["turns"] = conversation_id, state["turns"] + 1
+        if conversation_id not in self.conversation_ids:
+            self.conversation_ids.append(conversation_id)
+            if len(self.conversation_ids) > 1000:
+                self.conversation_ids.pop(0)
+        return True
+
+    async def run_operation(self, name: str, state: Dict[str, Any]) -> bool:
+        if name == "chat":
+            return await self.chat(state, stream=False)
+        if name == "chat_stream":
+            return await self.chat(state, stream=True)
+        if name == "conversations":
+            response = await self.client.get("/conversations", params={"limit": 20})
+            return response.status_code == 200
+        conversation_id = self.random.choice(self.conversation_ids)
+        response = await self.client.get(f"/conversations/{conversation_id}/messages", params={"limit": 20, "desc": True})
+        return response.status_code == 200
+
+    async def worker(self, stop_at: float, remaining: List[int]):
+        state: Dict[str, Any] = {"conversation_id": None, "turns": 0}
+        names, weights = list(self.mix), list(self.mix.values())
+        while time.monotonic() < stop_at and (remaining[0] is None or remaining[0] > 0):
+            if remaining[0] is not None:
+                remaining[0] -= 1
+            name = self.random.choices(names, weights)[0]
+            if name == "messages" and not self.conversation_ids:
+                # Nothing to page through yet: start a conversation first
+                name = "chat"
+                self.stats.setdefault(name, OperationStats())
+            token = current_operation.set(name)
+            started = time.perf_counter()
+            try:
+                ok = await self.run_operation(name, state)
+            except httpx.HTTPError:
+                ok = False
+            finally:
+                current_operation.reset(token)
+            elapsed = time.perf_counter() - started
+            if self.measuring:
+                if ok:
+                    self.stats[name].latencies.append(elapsed)
+                else:
+                    self.stats[name].errors += 1
+
+    async def run(self) -> Dict[str, Any]:
+        if self.args.warmup > 0:
+            warmup_until = time.monotonic() + self.args.warmup
+            await asyncio.gather(*(self.worker(warmup_until, [None]) for _ in range(self.args.concurrency)))
+
+        self.measuring = True
+        started = time.monotonic()
+        stop_at = started + (self.args.duration if self.args.requests is None else 10 ** 9)
+        remaining = [self.args.requests]
+        await asyncio.gather(*(self.worker(stop_at, remaining) for _ in range(self.args.concurrency)))
+        duration = time.monotonic() - started
+        self.measuring = False
+
+        operations = {name: stats.report(duration) for name, stats in self.stats.items()}
+        total = sum(len(stats.latencies) for stats in self.stats.values())
+        return {
+            "duration_s": round(duration, 2),
+            "requests": total,
+            "errors": sum(stats.errors for stats in self.stats.values()),
+            "rps": round(total / duration, 2) if duration else 0.0,
+            "operations": operations,
+        }
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout) as client:
+            return await Benchmark(client, args).run()
+
+    # In-process: drive the ASGI app directly and count its database statements
+    os.environ["OPENAI_BASE_URL"] = args.openai_base_url
+    os.environ.setdefault("OPENAI_API_KEY", "fake-key")
+    # Every simulated user shares one client address: lift the per-client rate limit
+    os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    from sqlalchemy import event
+    from app.database import engine
+    from app.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=args.timeout) as client:
+            benchmark = Benchmark(client, args)
+            sync_engine = engine.sync_engine
+            listeners = [
+                ("before_cursor_execute", lambda *a, **kw: benchmark.record_db()),
+                ("begin", lambda *a: benchmark.record_db(round_trip_only=True)),
+                ("commit", lambda *a: benchmark.record_db(round_trip_only=True)),
+                ("rollback", lambda *a: benchmark.record_db(round_trip_only=True)),
+            ]
+            for name, listener in listeners:
+                event.listen(sync_engine, name, listener)
+            try:
+                return await benchmark.run()
+            finally:
+                for name, listener in listeners:
+                    event.remove(sync_engine, name, listener)
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """List the metrics that regressed by more than `tolerance` against the baseline"""
+    regressions = []
+    for name, current in results["results"]["operations"].items():
+        previous = baseline.get("results", {}).get("operations", {}).get(name)
+        if not previous or not current["count"]:
+            continue
+        for q in ("p50", "p95", "p99"):
+            before, after = previous["latency_ms"].get(q), current["latency_ms"].get(q)
+            if before and after and after > before * (1 + tolerance):
+                regressions.append(f"{name} {q}: {before}ms -> {after}ms")
+        if previous["rps"] and current["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(f"{name} rps: {previous['rps']} -> {current['rps']}")
+        for key in ("db_round_trips_per_request", "db_statements_per_request"):
+            before, after = previous.get(key), current.get(key)
+            if before is not None and after is not None and after > before + 0.01:
+                regressions.append(f"{name} {key}: {before} -> {after}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Benchmark a running server instead of the in-process app (no DB counts)")
+    parser.add_argument("--openai-base-url", help="Use this OpenAI-compatible server instead of starting the fake one")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds to measure for")
+    parser.add_argument("--requests", type=int, default=None, help="Stop after this many requests instead")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Unmeasured seconds before measuring")
+    parser.add_argument("--mix", default="chat=6,conversations=2,messages=2",
+                        help="Weighted operations: chat, chat_stream, conversations, messages")
+    parser.add_argument("--turns", type=int, default=5, help="Turns per conversation before starting a new one")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline JSON to compare with; exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression against the baseline")
+    add_fake_openai_arguments(parser)
+    args = parser.parse_args()
+
+    fake_openai = None
+    if not args.url and not args.openai_base_url:
+        fake_openai = start_fake_openai(args)
+    try:
+        results = asyncio.run(run_benchmark(args))
+    finally:
+        if fake_openai is not None:
+            fake_openai.terminate()
+            fake_openai.wait()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    if fake_openai is not None:
+        config["openai_base_url"] = "fake_openai"
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": config,
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+    print(json.dumps(report["results"], indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against " + args.compare + ":\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("No regressions against " + args.compare)
+
+if __name__ == "__main__":
+    main()
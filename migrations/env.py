@@ -0,0 +1,89 @@
+import asyncio
+import re
+from logging.config import fileConfig
+
+from sqlalchemy.engine import Connection
+
+from alembic import context
+
+from app.database import Base, DATABASE_URL, engine
+import app.conversation  # noqa: F401 - registers the models on Base.metadata
+import app.idempotency  # noqa: F401
+
+# this is the Alembic Config object, which provides
+# access to the values within the .ini file in use.
+config = context.config
+
+# Interpret the config file for Python logging.
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+# Models metadata, for 'autogenerate' support
+target_metadata = Base.metadata
+
+# Full-text search columns and indexes: created on Postgres by 0004, and not mapped on the models
+SEARCH_COLUMNS = {("messages", "search_vector"), ("conversations", "search_vector")}
+SEARCH_INDEXES = {"ix_messages_search_vector", "ix_conversations_search_vector"}
+
+# Monthly and default partitions of messages, created by 0005 and app/retention.py.
+# Postgres reflects them as tables of their own.
+MESSAGE_PARTITION_NAME = re.compile(r"^messages_(default|\d{4}_\d{2})$")
+
+
+def include_name(name, type_, parent_names) -> bool:
+    """Leave the partitions of messages out of autogenerate: the models map only the parent table"""
+    if type_ == "table":
+        return not MESSAGE_PARTITION_NAME.match(name)
+    return True
+
+
+def include_object(object, name, type_, reflected, compare_to) -> bool:
+    """Leave out of autogenerate the database objects the models deliberately do not map"""
+    if reflected and compare_to is None:
+        if type_ == "column" and (object.table.name, name) in SEARCH_COLUMNS:
+            return False
+        if type_ == "index" and name in SEARCH_INDEXES:
+            return False
+    return True
+
+
+def run_migrations_offline() -> None:
+    """Run migrations in 'offline' mode, emitting the SQL to the script output."""
+    context.configure(
+        url=DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+        include_name=include_name,
+        include_object=include_object,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def do_run_migrations(connection: Connection) -> None:
+    context.configure(connection=connection, target_metadata=target_metadata,
+                      include_name=include_name, include_object=include_object)
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_async_migrations() -> None:
+    """Run the migrations through the application's async engine."""
+    async with engine.connect() as connection:
+        await connection.run_sync(do_run_migrations)
+
+    await engine.dispose()
+
+
+def run_migrations_online() -> None:
+    """Run migrations in 'online' mode."""
+    asyncio.run(run_async_migrations())
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
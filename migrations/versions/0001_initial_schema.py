@@ -0,0 +1,53 @@
+"""Initial schema: conversations and messages
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 00:00:00
+
+Databases created by the former create_all at startup already have these
+tables, so they are only created when missing.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table("conversations"):
+        op.create_table(
+            "conversations",
+            sa.Column("id", sa.String(), primary_key=True),
+            sa.Column("topic", sa.Text(), nullable=True),
+            sa.Column("user_stance", sa.Text(), nullable=True),
+            sa.Column("bot_stance", sa.Text(), nullable=True),
+            sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sa.Column("updated_at", sa.DateTime(timezone=True), nullable=True),
+        )
+
+    if not inspector.has_table("messages"):
+        op.create_table(
+            "messages",
+            sa.Column("id", sa.Integer(), primary_key=True, autoincrement=True),
+            sa.Column("conversation_id", sa.String(), sa.ForeignKey("conversations.id"), nullable=False),
+            sa.Column("role", sa.String(), nullable=False),
+            sa.Column("content", sa.Text(), nullable=False),
+            sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+            sqlite_autoincrement=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("messages")
+    op.drop_table("conversations")
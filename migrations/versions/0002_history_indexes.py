@@ -0,0 +1,42 @@
+"""Indexes for history loads and recency ordering
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:01
+
+(conversation_id, id) serves the `WHERE conversation_id = ? ORDER BY id DESC
+LIMIT n` history window and the message pages. Being its leading column,
+it also serves plain lookups by conversation_id, so no separate index is
+added for it. The indexes are built concurrently so existing tables are not
+locked against writes.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, Sequence[str], None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_messages_conversation_id_id", "messages", ["conversation_id", "id"],
+            postgresql_concurrently=True, if_not_exists=True
+        )
+        op.create_index(
+            "ix_conversations_updated_at", "conversations", ["updated_at"],
+            postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_conversations_updated_at", table_name="conversations", postgresql_concurrently=True)
+        op.drop_index("ix_messages_conversation_id_id", table_name="messages", postgresql_concurrently=True)
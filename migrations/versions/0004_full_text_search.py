@@ -0,0 +1,61 @@
+"""Full-text search over messages and conversation topics
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 00:00:03
+
+The tsvector columns are stored generated columns, so Postgres keeps them up
+to date on every insert and update without any application code, and the GIN
+indexes built on them serve `search_vector @@ query`. Adding a stored
+generated column rewrites the table once; the indexes are then built
+concurrently. The text search configuration must match SEARCH_CONFIG in
+app/search.py.
+
+Full-text search is Postgres-only: on SQLite this revision does nothing.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, Sequence[str], None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    op.add_column(
+        "messages",
+        sa.Column("search_vector", TSVECTOR(), sa.Computed("to_tsvector('english', content)", persisted=True))
+    )
+    op.add_column(
+        "conversations",
+        sa.Column("search_vector", TSVECTOR(), sa.Computed("to_tsvector('english', coalesce(topic, ''))", persisted=True))
+    )
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_messages_search_vector", "messages", ["search_vector"],
+            postgresql_using="gin", postgresql_concurrently=True, if_not_exists=True
+        )
+        op.create_index(
+            "ix_conversations_search_vector", "conversations", ["search_vector"],
+            postgresql_using="gin", postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != "postgresql":
+        return
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_conversations_search_vector", table_name="conversations", postgresql_concurrently=True)
+        op.drop_index("ix_messages_search_vector", table_name="messages", postgresql_concurrently=True)
+    op.drop_column("conversations", "search_vector")
+    op.drop_column("messages", "search_vector")
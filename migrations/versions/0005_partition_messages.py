@@ -0,0 +1,141 @@
+"""Partition messages by month of created_at, and mark archived conversations
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 00:00:04
+
+messages becomes a table partitioned by range of created_at, with one
+partition per month (named messages_YYYY_MM, bounds in UTC) and a default
+partition that catches rows no monthly partition covers. Partitions for the
+coming months are created by app/retention.py, which also archives idle
+conversations and drops the old partitions they leave empty.
+
+The partition key must be part of the primary key, so it becomes
+(id, created_at); ids still come from the same sequence and stay unique.
+Existing rows are copied into the new table, which locks messages for the
+duration of the migration: on a large table, run it in a maintenance window.
+
+Partitioning is Postgres-only: on SQLite, archived_at is added and
+messages.created_at becomes NOT NULL, as it is on Postgres.
+"""
+from typing import Sequence, Union
+import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, Sequence[str], None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Monthly partitions created ahead of the current month
+MONTHS_AHEAD = 3
+
+
+def _message_indexes() -> None:
+    op.create_index("ix_messages_conversation_id_id", "messages", ["conversation_id", "id"])
+    op.create_index("ix_messages_search_vector", "messages", ["search_vector"], postgresql_using="gin")
+
+
+def _set_sqlite_created_at_nullable(nullable: bool) -> None:
+    # SQLite cannot alter a column: batch mode recreates the table (keeping its AUTOINCREMENT ids)
+    with op.batch_alter_table("messages", table_kwargs={"sqlite_autoincrement": True}) as batch_op:
+        batch_op.alter_column("created_at", existing_type=sa.DateTime(timezone=True),
+                              existing_server_default=sa.func.now(), nullable=nullable)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("conversations", sa.Column("archived_at", sa.DateTime(timezone=True), nullable=True))
+    if op.get_bind().dialect.name != "postgresql":
+        messages = sa.table("messages", sa.column("created_at", sa.DateTime()))
+        # Naive UTC, as app.database.UTCDateTime stores it
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        op.execute(messages.update().where(messages.c.created_at.is_(None)).values(created_at=now))
+        _set_sqlite_created_at_nullable(False)
+        return
+
+    # Keep the id sequence, and free the index and constraint names for the new table
+    sequence = op.get_bind().execute(sa.text("SELECT pg_get_serial_sequence('messages', 'id')")).scalar()
+    op.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+    op.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    op.execute("ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey")
+    op.drop_index("ix_messages_conversation_id_id", table_name="messages_unpartitioned")
+    op.drop_index("ix_messages_search_vector", table_name="messages_unpartitioned")
+
+    op.execute(f"""
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('{sequence}'),
+            conversation_id VARCHAR NOT NULL CONSTRAINT messages_conversation_id_fkey REFERENCES conversations (id),
+            role VARCHAR NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            search_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+            CONSTRAINT messages_pkey PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute(f"ALTER SEQUENCE {sequence} OWNED BY messages.id")
+    op.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+    op.execute(f"""
+        DO $$
+        DECLARE
+            month TIMESTAMP := date_trunc('month', coalesce(
+                (SELECT min(created_at) FROM messages_unpartitioned), now()
+            ) AT TIME ZONE 'UTC');
+        BEGIN
+            WHILE month < date_trunc('month', now() AT TIME ZONE 'UTC') + interval '{MONTHS_AHEAD} months' LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                    'messages_' || to_char(month, 'YYYY_MM'),
+                    month::text || '+00',
+                    (month + interval '1 month')::text || '+00'
+                );
+                month := month + interval '1 month';
+            END LOOP;
+        END $$
+    """)
+    op.execute("""
+        INSERT INTO messages (id, conversation_id, role, content, created_at)
+        SELECT id, conversation_id, role, content, coalesce(created_at, now())
+        FROM messages_unpartitioned
+    """)
+    op.drop_table("messages_unpartitioned")
+    _message_indexes()
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != "postgresql":
+        _set_sqlite_created_at_nullable(True)
+        op.drop_column("conversations", "archived_at")
+        return
+
+    sequence = op.get_bind().execute(sa.text("SELECT pg_get_serial_sequence('messages', 'id')")).scalar()
+    op.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+    op.execute("ALTER TABLE messages RENAME TO messages_partitioned")
+    op.execute("ALTER TABLE messages_partitioned RENAME CONSTRAINT messages_pkey TO messages_partitioned_pkey")
+    op.drop_index("ix_messages_conversation_id_id", table_name="messages_partitioned")
+    op.drop_index("ix_messages_search_vector", table_name="messages_partitioned")
+
+    op.execute(f"""
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval('{sequence}') PRIMARY KEY,
+            conversation_id VARCHAR NOT NULL CONSTRAINT messages_conversation_id_fkey REFERENCES conversations (id),
+            role VARCHAR NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+            search_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED
+        )
+    """)
+    op.execute(f"ALTER SEQUENCE {sequence} OWNED BY messages.id")
+    op.execute("""
+        INSERT INTO messages (id, conversation_id, role, content, created_at)
+        SELECT id, conversation_id, role, content, created_at FROM messages_partitioned
+    """)
+    # Dropping the partitioned table drops all of its partitions
+    op.drop_table("messages_partitioned")
+    _message_indexes()
+    op.drop_column("conversations", "archived_at")
@@ -0,0 +1,103 @@
+"""Message count, last message time and preview on conversations
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 00:00:05
+
+The application keeps the three columns up to date as it writes each turn,
+so /conversations lists conversations by recency, with their counts and
+previews, from the conversations table alone. (last_message_at, id) serves
+that listing; it replaces the index on updated_at, which no query uses.
+
+Existing conversations are backfilled from their messages in one pass.
+Messages already moved to the archive are not counted, and a conversation
+without messages takes its creation time as last_message_at. The preview
+length matches LAST_MESSAGE_PREVIEW_CHARS in app/conversation.py.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, Sequence[str], None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PREVIEW_CHARS = 200
+
+
+def _set_sqlite_last_message_at_nullable(nullable: bool) -> None:
+    # SQLite cannot alter a column: batch mode recreates the table. Dropping the old one must not
+    # trip the foreign keys of messages, and foreign key checks can only be switched outside a transaction
+    with op.get_context().autocommit_block():
+        op.execute("PRAGMA foreign_keys=OFF")
+    with op.batch_alter_table("conversations") as batch_op:
+        batch_op.alter_column("last_message_at", existing_type=sa.DateTime(timezone=True),
+                              nullable=nullable, server_default=sa.func.now() if not nullable else None)
+    with op.get_context().autocommit_block():
+        op.execute("PRAGMA foreign_keys=ON")
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("conversations", sa.Column("message_count", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("conversations", sa.Column("last_message_at", sa.DateTime(timezone=True), nullable=True))
+    op.add_column("conversations", sa.Column("last_message_preview", sa.Text(), nullable=True))
+
+    op.execute(f"""
+        UPDATE conversations SET
+            message_count = (SELECT count(*) FROM messages WHERE messages.conversation_id = conversations.id),
+            last_message_at = coalesce(
+                (SELECT max(created_at) FROM messages WHERE messages.conversation_id = conversations.id),
+                created_at
+            ),
+            last_message_preview = (
+                SELECT substr(content, 1, {PREVIEW_CHARS}) FROM messages
+                WHERE messages.conversation_id = conversations.id
+                ORDER BY id DESC LIMIT 1
+            )
+    """)
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        op.alter_column("conversations", "last_message_at", existing_type=sa.DateTime(timezone=True),
+                        nullable=False, server_default=sa.func.now())
+    else:
+        # SQLite timestamps are text, and CURRENT_TIMESTAMP defaults have no microseconds. Rewrite the
+        # backfilled values through the column type, so they all have the format SQLAlchemy writes and
+        # compare correctly against the listing cursors
+        conversations = sa.table("conversations", sa.column("id", sa.String()), sa.column("last_message_at", sa.DateTime()))
+        rows = bind.execute(sa.select(conversations.c.id, conversations.c.last_message_at)).all()
+        if rows:
+            bind.execute(
+                conversations.update()
+                .where(conversations.c.id == sa.bindparam("conversation_id"))
+                .values(last_message_at=sa.bindparam("value", type_=sa.DateTime())),
+                [{"conversation_id": row.id, "value": row.last_message_at} for row in rows]
+            )
+        _set_sqlite_last_message_at_nullable(False)
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_conversations_last_message_at_id", "conversations", ["last_message_at", "id"],
+            postgresql_concurrently=True, if_not_exists=True
+        )
+        op.drop_index("ix_conversations_updated_at", table_name="conversations", postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_conversations_updated_at", "conversations", ["updated_at"],
+            postgresql_concurrently=True, if_not_exists=True
+        )
+        op.drop_index("ix_conversations_last_message_at_id", table_name="conversations", postgresql_concurrently=True)
+    if op.get_bind().dialect.name != "postgresql":
+        # Dropping a column also recreates the table on SQLite
+        _set_sqlite_last_message_at_nullable(True)
+    op.drop_column("conversations", "last_message_preview")
+    op.drop_column("conversations", "last_message_at")
+    op.drop_column("conversations", "message_count")
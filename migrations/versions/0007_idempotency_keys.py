@@ -0,0 +1,43 @@
+"""Idempotency keys
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 00:00:06
+
+Requests sent with an Idempotency-Key are claimed here before they run, and
+their response is stored once they complete, so a retry is replayed by any
+worker, also after a restart (see app/idempotency.py). A claim without a
+response is a request still running; created_at dates it, so the claim of a
+worker that died can be taken over.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: Union[str, Sequence[str], None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "idempotency_keys",
+        sa.Column("key", sa.String(length=255), primary_key=True),
+        sa.Column("fingerprint", sa.String(length=64), nullable=False),
+        sa.Column("response", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.Column("completed_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    # Serves the purge of expired responses
+    op.create_index("ix_idempotency_keys_completed_at", "idempotency_keys", ["completed_at"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_idempotency_keys_completed_at", table_name="idempotency_keys")
+    op.drop_table("idempotency_keys")
@@ -0,0 +1,19 @@
+from typing import Optional, Sequence
+import pytest
+from app.conversation import Conversation, Message
+
+def _make_conversation(contents: Sequence[str], conversation_id: Optional[str] = None,
+                       summarized_through_id: Optional[int] = None) -> Conversation:
+    conversation = Conversation(conversation_id=conversation_id, topic="Cats", user_stance="Cats are good", bot_stance="Cats are bad")
+    conversation.summarized_through_id = summarized_through_id
+    # The user opens, then user and bot alternate; ids count from 1
+    for i, content in enumerate(contents, start=1):
+        message = Message(role="user" if i % 2 else "assistant", content=content)
+        message.id = i
+        conversation.recent_messages.append(message)
+    return conversation
+
+@pytest.fixture
+def make_conversation():
+    """Build an unsaved conversation whose recent messages are `contents`"""
+    return _make_conversation
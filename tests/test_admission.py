@@ -0,0 +1,100 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app.admission import AdmissionController, RateLimiter, TokenBucket
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=1.0, capacity=2, now=0.0)
+    assert bucket.take(0.0) == 0
+    assert bucket.take(0.0) == 0
+    assert bucket.take(0.0) == pytest.approx(1.0)
+    assert bucket.take(1.0) == 0
+
+def test_rate_limiter_is_per_client():
+    limiter = RateLimiter(per_minute=1, burst=2)
+    limiter.check("a")
+    limiter.check("a")
+    with pytest.raises(HTTPException) as error:
+        limiter.check("a")
+    assert error.value.status_code == 429
+    assert int(error.value.headers["Retry-After"]) >= 1
+    limiter.check("b")
+    assert limiter.rejected == 1
+
+def test_rate_limiter_disabled():
+    limiter = RateLimiter(per_minute=0, burst=1)
+    for _ in range(5):
+        limiter.check("a")
+
+def test_queue_is_fifo_and_bounded():
+    controller = AdmissionController(max_concurrency=1, queue_size=2, queue_timeout=5)
+    order = []
+
+    async def turn(name, release: asyncio.Event):
+        async with controller.admit():
+            order.append(name)
+            await release.wait()
+
+    async def run():
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(turn(name, release)) for name in ("first", "second", "third")]
+        await asyncio.sleep(0)
+        assert (controller.active, controller.waiting) == (1, 2)
+        # The queue is full: refused at once
+        with pytest.raises(HTTPException) as error:
+            async with controller.admit():
+                pass
+        assert error.value.status_code == 503 and "Retry-After" in error.value.headers
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["first", "second", "third"]
+    assert (controller.active, controller.waiting) == (0, 0)
+    assert controller.rejected_queue_full == 1
+
+def test_wait_past_deadline_is_refused():
+    controller = AdmissionController(max_concurrency=1, queue_size=10, queue_timeout=0.05)
+
+    async def run():
+        release = asyncio.Event()
+
+        async def hold():
+            async with controller.admit():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            async with controller.admit():
+                pass
+        assert error.value.status_code == 503
+        assert controller.waiting == 0
+        release.set()
+        await holder
+
+    asyncio.run(run())
+    assert controller.rejected_deadline == 1
+    assert controller.active == 0
+
+def test_expected_wait_beyond_client_timeout_is_refused_at_once():
+    controller = AdmissionController(max_concurrency=1, queue_size=10, queue_timeout=30)
+    controller.hold_seconds = 2.0
+
+    async def run():
+        release = asyncio.Event()
+
+        async def hold():
+            async with controller.admit():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException):
+            async with controller.admit(timeout=3):
+                pass
+        release.set()
+        await holder
+
+    asyncio.run(run())
+    assert controller.rejected_deadline == 1
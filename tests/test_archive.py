@@ -0,0 +1,48 @@
+import datetime
+from app.archive import ArchiveStore, ArchivedMessage, merge_messages, merge_pages
+
+def make_messages(ids):
+    return [ArchivedMessage(i, "user" if i % 2 else "assistant", f"message {i}", None) for i in ids]
+
+def test_write_and_read(tmp_path):
+    store = ArchiveStore(str(tmp_path))
+    created_at = datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    messages = [ArchivedMessage(1, "user", "Cats are great", created_at), ArchivedMessage(2, "assistant", "No", None)]
+    store.write("abc123", messages)
+    assert store.exists("abc123")
+    assert store.read("abc123") == messages
+    assert store.read("missing") == []
+
+def test_merge_skips_messages_already_archived():
+    merged = merge_messages(make_messages([1, 2, 3]), make_messages([3, 4]))
+    assert [msg.id for msg in merged] == [1, 2, 3, 4]
+
+def test_read_page_forward_and_backward(tmp_path):
+    store = ArchiveStore(str(tmp_path))
+    store.write("abc123", make_messages(range(1, 8)))
+    page, has_more = store.read_page("abc123", limit=3)
+    assert [msg.id for msg in page] == [1, 2, 3] and has_more
+    page, has_more = store.read_page("abc123", limit=3, after_id=6)
+    assert [msg.id for msg in page] == [7] and not has_more
+    page, has_more = store.read_page("abc123", limit=3, before_id=6)
+    assert [msg.id for msg in page] == [3, 4, 5] and has_more
+    page, has_more = store.read_page("abc123", limit=3, desc=True)
+    assert [msg.id for msg in page] == [7, 6, 5] and has_more
+    page, has_more = store.read_page("abc123", limit=3, desc=True, after_id=3)
+    assert [msg.id for msg in page] == [2, 1] and not has_more
+    page, has_more = store.read_page("abc123", limit=3, desc=True, before_id=3)
+    assert [msg.id for msg in page] == [6, 5, 4] and has_more
+    assert store.read_page("missing", limit=3) == ([], False)
+
+def test_merge_pages():
+    # Messages 3 and 4 are both archived and still in the database
+    archived, recent = make_messages([1, 2, 3, 4]), make_messages([3, 4, 5, 6, 7])
+    page, has_more = merge_pages(archived[:3], True, recent[:3], True, limit=2, skip=1)
+    assert [msg.id for msg in page] == [2, 3] and has_more
+    page, has_more = merge_pages(archived[::-1][:3], True, recent[::-1][:3], True, limit=3, desc=True)
+    assert [msg.id for msg in page] == [7, 6, 5] and has_more
+    # Walking backwards from before_id=6: the page ends right before the cursor
+    page, has_more = merge_pages(archived[-3:], True, recent[:3], False, limit=3, walking_backwards=True)
+    assert [msg.id for msg in page] == [3, 4, 5] and has_more
+    page, has_more = merge_pages(archived, False, recent, False, limit=10)
+    assert [msg.id for msg in page] == [1, 2, 3, 4, 5, 6, 7] and not has_more
@@ -0,0 +1,82 @@
+import asyncio
+import io
+import json
+from fastapi import HTTPException
+from app.batch import BatchRunner, load_checkpoint, read_records
+from app.chat import ChatMessage, ChatRequest, ChatResponse
+
+class FakeTurns:
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, request: ChatRequest) -> ChatResponse:
+        self.calls.append((request.conversation_id, request.message))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if request.message in self.fail_on:
+            raise HTTPException(status_code=502, detail="Error: down")
+        conversation_id = request.conversation_id or f"conv-{request.message}"
+        return ChatResponse(conversation_id=conversation_id, message=[ChatMessage(role="bot", message=f"re: {request.message}")])
+
+def make_lines(*records) -> list:
+    return [json.dumps(record) + "\n" for record in records]
+
+def run(runner: BatchRunner, lines: list):
+    return asyncio.run(runner.run(read_records(lines)))
+
+def test_conversation_turns_run_in_order():
+    turns = FakeTurns()
+    output = io.StringIO()
+    lines = make_lines(
+        {"id": "a1", "conversation_key": "a", "message": "a1"},
+        {"id": "b1", "conversation_key": "b", "message": "b1"},
+        {"id": "a2", "conversation_key": "a", "message": "a2"},
+        {"id": "c1", "message": "c1"},
+    )
+    counts = run(BatchRunner(output, concurrency=4, turn=turns), lines)
+    assert counts["ok"] == 4
+    # The second turn continues the conversation started by the first
+    assert ("conv-a1", "a2") in turns.calls
+    assert turns.calls.index((None, "a1")) < turns.calls.index(("conv-a1", "a2"))
+    assert turns.max_running > 1
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert {result["id"]: result["reply"] for result in results}["a2"] == "re: a2"
+
+def test_concurrency_is_bounded():
+    turns = FakeTurns()
+    lines = make_lines(*({"id": str(i), "message": f"m{i}"} for i in range(10)))
+    run(BatchRunner(io.StringIO(), concurrency=3, turn=turns), lines)
+    assert turns.max_running == 3
+
+def test_failed_turn_skips_rest_of_conversation():
+    turns = FakeTurns(fail_on={"a1"})
+    output = io.StringIO()
+    lines = make_lines(
+        {"id": "a1", "conversation_key": "a", "message": "a1"},
+        {"id": "a2", "conversation_key": "a", "message": "a2"},
+        {"id": "bad"},
+        "not json",
+    )
+    counts = run(BatchRunner(output, turn=turns), lines + ["{oops\n"])
+    assert counts == {"ok": 0, "error": 4, "skipped": 1, "resumed": 0}
+    assert [call[1] for call in turns.calls] == ["a1"]
+
+def test_resume_from_checkpoint():
+    lines = make_lines(
+        {"id": "a1", "conversation_key": "a", "message": "a1"},
+        {"id": "a2", "conversation_key": "a", "message": "a2"},
+    )
+    first_output = io.StringIO()
+    run(BatchRunner(first_output, turn=FakeTurns(fail_on={"a2"})), lines)
+
+    completed, conversation_ids = load_checkpoint(first_output.getvalue().splitlines())
+    assert completed == {"a1"}
+    turns = FakeTurns()
+    counts = run(BatchRunner(io.StringIO(), turn=turns, completed=completed, conversation_ids=conversation_ids), lines)
+    assert counts["resumed"] == 1 and counts["ok"] == 1
+    assert turns.calls == [("conv-a1", "a2")]
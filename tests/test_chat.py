@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app import chat as chat_module
+from app import summary as summary_module
+from app.admission import AdmissionController
+from app.chat import HISTORY_LIMIT, HISTORY_TOKEN_BUDGET, SUMMARY_BATCH, ChatRequest, history_window, run_turn, schedule_summary
+from app.conversation import Message
+
+def test_messages_cut_by_token_budget_are_summarized(monkeypatch, make_conversation):
+    summarized = []
+
+    async def update_conversation_summary(conversation_id, previous_summary, previous_through_id, messages):
+        summarized.extend(msg.content for msg in messages)
+        summary_module._in_progress.discard(conversation_id)
+    monkeypatch.setattr(summary_module, "update_conversation_summary", update_conversation_summary)
+
+    # A long message inside the last HISTORY_LIMIT messages pushes the opening out of the prompt
+    long_message = "x" * (8 * HISTORY_TOKEN_BUDGET)
+    conversation = make_conversation(["opening", "bot reply", long_message, "bot reply 2"])
+    assert [msg["content"] for msg in conversation.get_history_dict(HISTORY_LIMIT, HISTORY_TOKEN_BUDGET)] == ["bot reply 2"]
+
+    async def run():
+        task = schedule_summary(conversation)
+        assert task is not None
+        await task
+
+    asyncio.run(run())
+    assert summarized == ["opening", "bot reply", long_message]
+
+def test_history_window_starts_after_the_summary(make_conversation):
+    conversation = make_conversation([f"message {i}" for i in range(1, 15)], summarized_through_id=4)
+    window = history_window(conversation)
+    assert window[0]["content"] == "message 5" and len(window) == 10
+
+    # Later turns send the same messages first, until the next summary fold
+    for i in range(15, 15 + SUMMARY_BATCH):
+        message = Message(role="user", content=f"message {i}")
+        message.id = i
+        conversation.recent_messages.append(message)
+        assert history_window(conversation)[:len(window)] == window
+
+def test_messages_within_budget_wait_for_a_batch(make_conversation):
+    conversation = make_conversation(["opening", "bot reply"])
+
+    async def run():
+        return schedule_summary(conversation)
+
+    assert asyncio.run(run()) is None
+
+def test_turn_takes_its_slot_once_it_holds_the_conversation_lock(monkeypatch):
+    controller = AdmissionController(max_concurrency=4, queue_size=10, queue_timeout=5)
+    release = asyncio.Event()
+
+    async def prepare_turn(request, db):
+        await release.wait()
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    monkeypatch.setattr(chat_module, "prepare_turn", prepare_turn)
+
+    async def turn():
+        request = ChatRequest(conversation_id="abc", message="Cats are great")
+        with pytest.raises(HTTPException):
+            await run_turn(request, None, admit=controller.admit)
+
+    async def run():
+        tasks = [asyncio.create_task(turn()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        # The other two turns wait for the conversation, not for a slot
+        assert (controller.active, controller.waiting) == (1, 0)
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert controller.admitted == 3 and controller.active == 0
@@ -0,0 +1,17 @@
+from app.conversation import estimate_tokens
+
+def test_get_history_dict_last_n(make_conversation):
+    conversation = make_conversation(["a", "b", "c", "d"])
+    assert [msg["content"] for msg in conversation.get_history_dict(2)] == ["c", "d"]
+
+def test_get_history_dict_token_budget_keeps_newest_messages(make_conversation):
+    long_message = "x" * 4000
+    conversation = make_conversation(["old", long_message, "recent", "newest"])
+    budget = estimate_tokens("recent") + estimate_tokens("newest")
+    history = conversation.get_history_dict(10, token_budget=budget)
+    assert [msg["content"] for msg in history] == ["recent", "newest"]
+
+def test_get_messages_to_summarize(make_conversation):
+    conversation = make_conversation(["m1", "m2", "m3", "m4", "m5", "m6"], summarized_through_id=1)
+    messages = conversation.get_messages_to_summarize(keep_last=2)
+    assert [msg.content for msg in messages] == ["m2", "m3", "m4"]
@@ -0,0 +1,42 @@
+import asyncio
+import datetime
+import pytest
+from sqlalchemy.dialects import postgresql, sqlite
+from app.database import UTCDateTime, WriteLock, async_database_url
+
+def test_async_database_url():
+    assert async_database_url("sqlite:///kopi.db") == "sqlite+aiosqlite:///kopi.db"
+    assert async_database_url("postgresql://user:pass@db/kopi") == "postgresql+asyncpg://user:pass@db/kopi"
+    assert async_database_url("postgresql+asyncpg://user:pass@db/kopi") == "postgresql+asyncpg://user:pass@db/kopi"
+    assert async_database_url("postgresql+psycopg2://user:pass@db/kopi") == "postgresql+asyncpg://user:pass@db/kopi"
+    assert async_database_url("postgres://user:pass@db/kopi") == "postgresql+asyncpg://user:pass@db/kopi"
+    assert async_database_url("sqlite+pysqlite:///kopi.db") == "sqlite+aiosqlite:///kopi.db"
+    with pytest.raises(ValueError):
+        async_database_url("mysql+pymysql://user:pass@db/kopi")
+
+def test_utc_datetime_on_sqlite():
+    column_type = UTCDateTime()
+    dialect = sqlite.dialect()
+    moment = datetime.datetime(2026, 1, 1, 12, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    stored = column_type.process_bind_param(moment, dialect)
+    assert stored == datetime.datetime(2026, 1, 1, 10)
+    assert column_type.process_result_value(stored, dialect) == moment
+    assert column_type.process_bind_param(moment, postgresql.dialect()) is moment
+
+def test_write_lock_serializes_writers():
+    lock = WriteLock(enabled=True)
+    active = []
+
+    async def write():
+        async with lock.hold():
+            active.append(1)
+            assert len(active) == 1
+            await asyncio.sleep(0.001)
+            active.pop()
+
+    async def run():
+        await asyncio.gather(*(write() for _ in range(5)))
+
+    # Also usable from a second event loop
+    asyncio.run(run())
+    asyncio.run(run())
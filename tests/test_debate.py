@@ -0,0 +1,31 @@
+import asyncio
+from app.conversation import Conversation
+from app.debate import Debate, DEBATE_INSTRUCTIONS
+
+class MockOpenAIResponse:
+    def __init__(self):
+        self.calls = []
+
+    async def get_response(self, system_prompt, conversation_history):
+        self.calls.append((system_prompt, conversation_history))
+        return "Mocked reply"
+
+def test_prompt_starts_with_static_instructions():
+    debate = Debate(topic="Cats", user_stance="Cats are good", bot_stance="Cats are bad")
+    mock = MockOpenAIResponse()
+    debate._Debate__openai_response = mock
+    reply = asyncio.run(debate.chat("Cats are great", [{"role": "assistant", "content": "No"}], summary="Earlier points"))
+    assert reply == "Mocked reply"
+    system_prompt, history = mock.calls[0]
+    assert system_prompt == DEBATE_INSTRUCTIONS
+    assert "Cats" not in system_prompt
+    assert "Cats are bad" in history[0]["content"]
+    assert "Earlier points" in history[1]["content"]
+    assert history[-1] == {"role": "user", "content": "Cats are great"}
+
+def test_for_conversation_reuses_debate():
+    conversation = Conversation(topic="Cats", user_stance="Cats are good", bot_stance="Cats are bad")
+    debate = Debate.for_conversation(conversation)
+    assert Debate.for_conversation(conversation) is debate
+    conversation.bot_stance = "Cats are overrated"
+    assert Debate.for_conversation(conversation) is not debate
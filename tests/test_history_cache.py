@@ -0,0 +1,50 @@
+from app.history_cache import HistoryCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+# Four messages, the user's first
+MESSAGES = [f"message {i}" for i in range(4)]
+
+def test_get_returns_cached_window(make_conversation):
+    cache = HistoryCache()
+    cache.put(make_conversation([f"message {i}" for i in range(12)], "c1"), window=10)
+    conversation = cache.get("c1")
+    assert conversation is not None
+    assert conversation.topic == "Cats"
+    assert conversation.bot_stance == "Cats are bad"
+    assert len(conversation.recent_messages) == 10
+    assert conversation.get_history_dict()[-1] == {"role": "assistant", "content": "message 11"}
+    assert cache.get("c2") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_least_recently_used_is_evicted(make_conversation):
+    cache = HistoryCache(max_entries=2)
+    cache.put(make_conversation(MESSAGES, "c1"), window=10)
+    cache.put(make_conversation(MESSAGES, "c2"), window=10)
+    cache.get("c1")
+    cache.put(make_conversation(MESSAGES, "c3"), window=10)
+    assert cache.get("c2") is None
+    assert cache.get("c1") is not None
+    assert cache.get("c3") is not None
+    assert cache.evictions == 1
+
+def test_memory_cap_is_respected(make_conversation):
+    cache = HistoryCache(max_bytes=3000)
+    for i in range(10):
+        cache.put(make_conversation(MESSAGES, f"c{i}"), window=10)
+    assert cache.size_bytes <= 3000
+    assert 0 < len(cache) < 10
+
+def test_entries_expire(make_conversation):
+    clock = FakeClock()
+    cache = HistoryCache(ttl_seconds=60, clock=clock)
+    cache.put(make_conversation(MESSAGES, "c1"), window=10)
+    clock.now = 61
+    assert cache.get("c1") is None
+    assert len(cache) == 0
+    assert cache.size_bytes == 0
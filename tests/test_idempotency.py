@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from app.idempotency import IdempotencyStore
+from app.locks import ConversationLocks
+
+def test_completed_result_is_replayed():
+    store = IdempotencyStore()
+    calls = []
+
+    async def turn():
+        calls.append(1)
+        return "reply"
+
+    async def run():
+        first = await store.run("key", "fp", turn)
+        second = await store.run("key", "fp", turn)
+        return first, second
+
+    assert asyncio.run(run()) == (("reply", False), ("reply", True))
+    assert len(calls) == 1
+
+def test_in_flight_duplicates_share_one_call():
+    store = IdempotencyStore()
+    calls = []
+
+    async def turn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "reply"
+
+    async def run():
+        return await asyncio.gather(*(store.run("key", "fp", turn) for _ in range(3)))
+
+    results = asyncio.run(run())
+    assert [result for result, _ in results] == ["reply"] * 3
+    assert sorted(replayed for _, replayed in results) == [False, True, True]
+    assert len(calls) == 1
+
+def test_failure_is_not_stored():
+    store = IdempotencyStore()
+
+    async def failing():
+        raise HTTPException(status_code=502, detail="Error: down")
+
+    async def succeeding():
+        return "reply"
+
+    async def run():
+        with pytest.raises(HTTPException):
+            await store.run("key", "fp", failing)
+        return await store.run("key", "fp", succeeding)
+
+    assert asyncio.run(run()) == ("reply", False)
+
+def test_key_reused_with_different_request():
+    store = IdempotencyStore()
+
+    async def turn():
+        return "reply"
+
+    async def run():
+        await store.run("key", "fp", turn)
+        await store.run("key", "other", turn)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(run())
+    assert error.value.status_code == 422
+
+def test_completed_result_expires():
+    now = [0.0]
+    store = IdempotencyStore(ttl_seconds=10, clock=lambda: now[0])
+
+    async def run():
+        await store.run("key", "fp", lambda: asyncio.sleep(0, "first"))
+        now[0] = 11
+        return await store.run("key", "fp", lambda: asyncio.sleep(0, "second"))
+
+    assert asyncio.run(run()) == ("second", False)
+
+def test_conversation_turns_are_serialized():
+    locks = ConversationLocks()
+    events = []
+
+    async def turn(name: str):
+        async with locks.hold("c1"):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def run():
+        await asyncio.gather(turn("a"), turn("b"))
+
+    asyncio.run(run())
+    assert events == ["a start", "a end", "b start", "b end"]
+    assert len(locks) == 0
@@ -1,15 +1,34 @@
+import json
+import uuid
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app.admission import rate_limiter
+from app.history_cache import history_cache
+from app.idempotency import idempotency_store
+from app.database import IS_SQLITE
+from app.pagination import encode_cursor
+from app import search as search_module
 
-client = TestClient(app)
+postgres_only = pytest.mark.skipif(IS_SQLITE, reason="needs the PostgreSQL backend")
 
-def test_root():
+@pytest.fixture(scope="module")
+def client():
+    # Entering the client runs the lifespan and keeps a single event loop,
+    # which the async engine's pooled connections are bound to.
+    # Every test request comes from the same client: lift its rate limit
+    rate = rate_limiter.rate
+    rate_limiter.rate = 0
+    with TestClient(app) as test_client:
+        yield test_client
+    rate_limiter.rate = rate
+
+def test_root(client):
     resp = client.get("/")
     assert resp.status_code == 200
     assert "docs" in resp.json()
 
-def test_chat_new_conversation():
+def test_chat_new_conversation(client):
     resp = client.post("/chat", json={"conversation_id": None, "message": "Is AI dangerous?"})
     assert resp.status_code == 200
     data = resp.json()
@@ -17,7 +36,7 @@ def test_chat_new_conversation():
     assert isinstance(data["message"], list)
     assert data["message"][-1]["role"] == "bot"
 
-def test_chat_existing_conversation():
+def test_chat_existing_conversation(client):
     # Start a new conversation
     resp1 = client.post("/chat", json={"conversation_id": None, "message": "Is the Earth flat?"})
     conv_id = resp1.json()["conversation_id"]
@@ -26,12 +45,61 @@ def test_chat_existing_conversation():
     assert resp2.status_code == 200
     assert resp2.json()["conversation_id"] == conv_id
 
-def test_list_conversations():
+def test_chat_stream(client):
+    with client.stream("POST", "/chat/stream", json={"conversation_id": None, "message": "Is AI dangerous?"}) as resp:
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/event-stream")
+        body = "".join(resp.iter_text())
+    assert "event: token" in body
+    done = body.split("event: done\ndata: ")[-1].strip()
+    data = json.loads(done)
+    assert data["message"][-1]["role"] == "bot"
+
+def test_metrics(client):
+    client.post("/chat", json={"conversation_id": None, "message": "Is coffee healthy?"})
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/plain")
+    body = resp.text
+    assert 'debate_stage_duration_seconds_count{stage="llm_call"}' in body
+    assert 'debate_llm_tokens_total{kind="prompt"}' in body
+    assert "debate_db_pool_checked_out" in body
+    assert "debate_threadpool_busy" in body
+
+def test_list_conversations(client):
     resp = client.get("/conversations")
     assert resp.status_code == 200
     assert isinstance(resp.json(), list)
 
-def test_list_conversation_messages():
+def test_list_conversations_by_recency(client):
+    older = client.post("/chat", json={"conversation_id": None, "message": "Is summer better than winter?"}).json()["conversation_id"]
+    newer = client.post("/chat", json={"conversation_id": None, "message": "Are cats better than dogs?"}).json()["conversation_id"]
+    # A new turn moves the older conversation back to the top
+    resp = client.post("/chat", json={"conversation_id": older, "message": "Summer has longer days"})
+    bot_reply = resp.json()["message"][-1]["message"]
+    listed = client.get("/conversations", params={"limit": 2}).json()
+    assert [conv["id"] for conv in listed] == [older, newer]
+    assert listed[0]["message_count"] == 4
+    assert listed[0]["last_message_preview"] == bot_reply[:200]
+    assert listed[0]["last_message_at"] >= listed[1]["last_message_at"]
+
+def test_list_conversations_pagination(client):
+    for _ in range(3):
+        client.post("/chat", json={"conversation_id": None, "message": "Is remote work better?"})
+    page1 = client.get("/conversations", params={"limit": 2})
+    page2 = client.get("/conversations", params={"limit": 2, "after": page1.headers["X-Next-Cursor"]})
+    assert page2.status_code == 200
+    ids1 = [conv["id"] for conv in page1.json()]
+    ids2 = [conv["id"] for conv in page2.json()]
+    assert len(ids1) == len(ids2) == 2 and not set(ids1) & set(ids2)
+    # Same as the first four of one bigger page
+    assert ids1 + ids2 == [conv["id"] for conv in client.get("/conversations", params={"limit": 4}).json()]
+
+def test_list_conversations_invalid_cursor(client):
+    resp = client.get("/conversations", params={"after": "not-a-cursor!"})
+    assert resp.status_code == 400
+
+def test_list_conversation_messages(client):
     # Start a new conversation
     resp1 = client.post("/chat", json={"conversation_id": None, "message": "Test message"})
     conv_id = resp1.json()["conversation_id"]
@@ -43,10 +111,177 @@ def test_list_conversation_messages():
     assert any(msg["role"] == "user" for msg in messages)
     assert any(msg["role"] == "bot" for msg in messages)
 
-def test_list_conversation_messages_not_found():
+def test_list_conversation_messages_cursor(client):
+    resp1 = client.post("/chat", json={"conversation_id": None, "message": "Is the Earth flat?"})
+    conv_id = resp1.json()["conversation_id"]
+    client.post("/chat", json={"conversation_id": conv_id, "message": "Why do you think so?"})
+    # Walk the 4 messages two at a time
+    page1 = client.get(f"/conversations/{conv_id}/messages", params={"limit": 2})
+    assert page1.status_code == 200
+    assert "X-Next-Cursor" in page1.headers
+    page2 = client.get(f"/conversations/{conv_id}/messages", params={"limit": 2, "after": page1.headers["X-Next-Cursor"]})
+    assert page2.status_code == 200
+    assert "X-Next-Cursor" not in page2.headers
+    assert [msg["role"] for msg in page1.json() + page2.json()] == ["user", "bot", "user", "bot"]
+    page0 = client.get(f"/conversations/{conv_id}/messages", params={"limit": 2, "before": page2.headers["X-Prev-Cursor"]})
+    assert page0.json() == page1.json()
+
+def test_list_conversation_messages_invalid_cursor(client):
+    resp = client.get("/conversations/doesnotexist/messages", params={"after": "not-a-cursor!"})
+    assert resp.status_code == 400
+    # A well-formed cursor holding JSON `true` instead of a message id
+    resp = client.get("/conversations/doesnotexist/messages", params={"after": encode_cursor(True)})
+    assert resp.status_code == 400
+
+@postgres_only
+def test_search(client):
+    # A word of its own, so results of earlier runs cannot push this conversation off the page
+    word = "vaccine" + uuid.uuid4().hex[:8]
+    resp = client.post("/chat", json={"conversation_id": None, "message": f"Vaccines should be mandatory, says {word}"})
+    conv_id = resp.json()["conversation_id"]
+    resp = client.get("/search", params={"q": f"vaccines {word}"})
+    assert resp.status_code == 200
+    results = {result["conversation_id"]: result for result in resp.json()}
+    assert "**Vaccines**" in results[conv_id]["snippet"]
+    assert results[conv_id]["matches"] >= 1
+    assert "X-Search-Truncated" not in resp.headers
+
+@postgres_only
+def test_search_truncated(client, monkeypatch):
+    monkeypatch.setattr(search_module, "SEARCH_MAX_MATCHES", 1)
+    word = "recycling" + uuid.uuid4().hex[:8]
+    client.post("/chat", json={"conversation_id": None, "message": f"Is {word} worth it?"})
+    newer = client.post("/chat", json={"conversation_id": None, "message": f"Is {word} worth it?"}).json()["conversation_id"]
+    resp = client.get("/search", params={"q": word})
+    assert resp.status_code == 200
+    assert resp.headers["X-Search-Truncated"] == "true"
+    # The most recent match is the one ranked
+    assert [result["conversation_id"] for result in resp.json()] == [newer]
+
+@postgres_only
+def test_search_pagination(client):
+    for _ in range(3):
+        client.post("/chat", json={"conversation_id": None, "message": "Is homework useful?"})
+    resp1 = client.get("/search", params={"q": "homework", "limit": 2})
+    assert resp1.status_code == 200
+    assert len(resp1.json()) == 2
+    cursor = resp1.headers["X-Next-Cursor"]
+    resp2 = client.get("/search", params={"q": "homework", "limit": 2, "after": cursor})
+    assert resp2.status_code == 200
+    first_page = {result["conversation_id"] for result in resp1.json()}
+    assert not first_page & {result["conversation_id"] for result in resp2.json()}
+
+@postgres_only
+def test_search_invalid_cursor(client):
+    resp = client.get("/search", params={"q": "homework", "after": "not-a-cursor"})
+    assert resp.status_code == 400
+
+@pytest.mark.skipif(not IS_SQLITE, reason="only on the SQLite backend")
+def test_search_unavailable_on_sqlite(client):
+    resp = client.get("/search", params={"q": "homework"})
+    assert resp.status_code == 501
+
+def test_export(client):
+    resp = client.post("/chat", json={"conversation_id": None, "message": "Is chess a sport?"})
+    conv_id = resp.json()["conversation_id"]
+    resp = client.get("/export")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    conversations = {line["id"]: line for line in map(json.loads, resp.text.splitlines())}
+    assert [msg["role"] for msg in conversations[conv_id]["messages"]] == ["user", "bot"]
+
+def test_export_filters(client):
+    resp = client.get("/export", params={"created_after": "2999-01-01T00:00:00Z"})
+    assert resp.status_code == 200
+    assert resp.text == ""
+
+def test_archived_conversation(client, tmp_path, monkeypatch):
+    from app.archive import archive_store
+    from app.database import engine
+    from app.history_cache import history_cache
+    from app.retention import archive_conversations
+
+    monkeypatch.setattr(archive_store, "directory", str(tmp_path))
+    resp = client.post("/chat", json={"conversation_id": None, "message": "Should cities ban cars?"})
+    conv_id = resp.json()["conversation_id"]
+    before = client.get(f"/conversations/{conv_id}/messages").json()
+
+    async def archive():
+        async with engine.connect() as conn:
+            return await archive_conversations(conn, [conv_id])
+
+    assert client.portal.call(archive) == 2
+    assert archive_store.exists(conv_id)
+    # Still readable, and can be continued
+    assert client.get(f"/conversations/{conv_id}/messages").json() == before
+    history_cache.invalidate(conv_id)
+    resp = client.post("/chat", json={"conversation_id": conv_id, "message": "Cars pollute"})
+    assert resp.status_code == 200
+    messages = client.get(f"/conversations/{conv_id}/messages").json()
+    assert messages[:2] == before and len(messages) == 4
+    # Pages cross from the archive to the database and back
+    for desc in (False, True):
+        pages, cursor = [], None
+        while True:
+            resp = client.get(f"/conversations/{conv_id}/messages", params={"limit": 3, "desc": desc, "after": cursor})
+            pages += resp.json()
+            cursor = resp.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        assert pages == (messages[::-1] if desc else messages)
+    first = client.get(f"/conversations/{conv_id}/messages", params={"limit": 3})
+    last = client.get(f"/conversations/{conv_id}/messages", params={"limit": 3, "after": first.headers["X-Next-Cursor"]})
+    back = client.get(f"/conversations/{conv_id}/messages", params={"limit": 3, "before": last.headers["X-Prev-Cursor"]})
+    assert back.json() == messages[:3]
+    exported = [json.loads(line) for line in client.get("/export").text.splitlines()]
+    assert len(next(conv for conv in exported if conv["id"] == conv_id)["messages"]) == 4
+
+def test_chat_idempotency_key_replayed_by_another_worker(client):
+    key = str(uuid.uuid4())
+    body = {"conversation_id": None, "message": "Should homework be banned?"}
+    first = client.post("/chat", json=body, headers={"Idempotency-Key": key})
+    assert first.status_code == 200
+    # Another worker, or this one after a restart, only has the database
+    idempotency_store.clear()
+    retry = client.post("/chat", json=body, headers={"Idempotency-Key": key})
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    conv_id = first.json()["conversation_id"]
+    assert len(client.get(f"/conversations/{conv_id}/messages").json()) == 2
+
+    idempotency_store.clear()
+    resp = client.post("/chat", json={**body, "message": "Something else"}, headers={"Idempotency-Key": key})
+    assert resp.status_code == 422
+
+def test_chat_answered_from_a_stale_history(client):
+    conv_id = client.post("/chat", json={"conversation_id": None, "message": "Is tea better than coffee?"}).json()["conversation_id"]
+    # As if another worker had written a turn since this one cached the conversation
+    history_cache._entries[conv_id].message_count -= 2
+    resp = client.post("/chat", json={"conversation_id": conv_id, "message": "Tea has less caffeine"})
+    assert resp.status_code == 409
+    assert len(client.get(f"/conversations/{conv_id}/messages").json()) == 2
+    # The retry reads the conversation from the database
+    resp = client.post("/chat", json={"conversation_id": conv_id, "message": "Tea has less caffeine"})
+    assert resp.status_code == 200
+    assert len(client.get(f"/conversations/{conv_id}/messages").json()) == 4
+
+def test_chat_rate_limited(client, monkeypatch):
+    monkeypatch.setattr(rate_limiter, "rate", 1 / 60)
+    monkeypatch.setattr(rate_limiter, "burst", 1)
+    rate_limiter.clear()
+    assert client.post("/chat", json={"conversation_id": None, "message": "Is tea better than coffee?"}).status_code == 200
+    resp = client.post("/chat", json={"conversation_id": None, "message": "Is tea better than coffee?"})
+    assert resp.status_code == 429
+    assert int(resp.headers["Retry-After"]) > 0
+    # Reads are not limited
+    assert client.get("/conversations").status_code == 200
+    rate_limiter.clear()
+
+def test_list_conversation_messages_not_found(client):
     resp = client.get("/conversations/doesnotexist/messages")
     assert resp.status_code == 404
 
-def test_chat_conversation_not_found():
+def test_chat_conversation_not_found(client):
     resp = client.post("/chat", json={"conversation_id": "doesnotexist", "message": "Hello"})
     assert resp.status_code == 404 
\ No newline at end of file
@@ -1,9 +1,14 @@
+import asyncio
+import httpx
+import openai
 import pytest
-from app.openai_response import OpenAI_Response
+from app import openai_response as openai_response_module
+from app.openai_response import OpenAI_Response, RetryBudget, UsageStats
+from app.topic import TopicExtraction
 
 class MockChatCompletions:
     @staticmethod
-    def create(model, messages, temperature, max_tokens):
+    async def create(model, messages, temperature, max_tokens, timeout):
         class MockChoices:
             def __init__(self):
                 self.message = type('obj', (object,), {'content': 'Mocked response'})
@@ -19,8 +24,132 @@ class MockClient:
 def test_get_completion(monkeypatch):
     openai_response = OpenAI_Response()
     openai_response.client = MockClient()
-    result = openai_response.get_completion(
+    result = asyncio.run(openai_response.get_completion(
         "Test system prompt",
         [{"role": "user", "content": "Test message"}]
-    )
-    assert result == "Mocked response" 
\ No newline at end of file
+    ))
+    assert result == "Mocked response"
+
+
+class FlakyResponses:
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    async def create(self, model, input, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/responses"))
+        return type('obj', (object,), {'output_text': 'Mocked response'})
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    async def no_sleep(delay):
+        pass
+    monkeypatch.setattr(openai_response_module.asyncio, "sleep", no_sleep)
+    monkeypatch.setattr(openai_response_module, "retry_budget", RetryBudget(ratio=0.2, reserve=10))
+
+def test_get_response_retries_transient_errors(no_backoff):
+    openai_response = OpenAI_Response(max_retries=2)
+    responses = FlakyResponses(failures=2)
+    openai_response.client = type('obj', (object,), {'responses': responses})
+    result = asyncio.run(openai_response.get_response("Test system prompt", [{"role": "user", "content": "Test message"}]))
+    assert result == "Mocked response"
+    assert responses.calls == 3
+
+def test_calls_use_the_timeout_of_their_route(no_backoff, monkeypatch):
+    monkeypatch.setitem(openai_response_module.ROUTE_TIMEOUTS, "extraction", 3.0)
+    timeouts = []
+    async def create(model, input, timeout, **kwargs):
+        timeouts.append(timeout)
+        return type('obj', (object,), {'output_text': 'Mocked response'})
+    for openai_response in (OpenAI_Response(route="extraction"), OpenAI_Response(route="extraction", timeout=1.0)):
+        openai_response.client = type('obj', (object,), {'responses': type('obj', (object,), {'create': staticmethod(create)})})
+        asyncio.run(openai_response.get_response("Test system prompt", [{"role": "user", "content": "Test message"}]))
+    assert [(timeout.read, timeout.connect) for timeout in timeouts] == [
+        (3.0, openai_response_module.OPENAI_CONNECT_TIMEOUT), (1.0, openai_response_module.OPENAI_CONNECT_TIMEOUT)
+    ]
+
+def test_failed_parsed_response_is_logged(no_backoff, caplog):
+    async def parse(**kwargs):
+        raise ValueError("not valid JSON")
+    openai_response = OpenAI_Response(route="extraction", max_retries=0)
+    openai_response.client = type('obj', (object,), {'responses': type('obj', (object,), {'parse': staticmethod(parse)})})
+    with caplog.at_level("WARNING", logger="app.openai_response"):
+        result = asyncio.run(openai_response.get_parsed_response("Test system prompt", [{"role": "user", "content": "Test message"}], TopicExtraction))
+    assert result is None
+    assert caplog.records[-1].levelname == "WARNING"
+    assert "route=extraction" in caplog.records[-1].getMessage()
+    assert caplog.records[-1].exc_info[0] is ValueError
+
+def test_get_response_gives_up_after_max_retries(no_backoff):
+    openai_response = OpenAI_Response(max_retries=1)
+    responses = FlakyResponses(failures=5)
+    openai_response.client = type('obj', (object,), {'responses': responses})
+    result = asyncio.run(openai_response.get_response("Test system prompt", [{"role": "user", "content": "Test message"}]))
+    assert result.startswith("Error:")
+    assert responses.calls == 2
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0.5, reserve=2)
+    assert budget.try_spend()
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    budget.record_call()
+    budget.record_call()
+    assert budget.try_spend()
+
+def test_usage_stats_records_cached_tokens():
+    stats = UsageStats()
+    details = type('obj', (object,), {'cached_tokens': 768})
+    usage = type('obj', (object,), {'input_tokens': 1024, 'output_tokens': 50, 'input_tokens_details': details})
+    stats.record("o4-mini", usage)
+    assert (stats.calls, stats.input_tokens, stats.cached_input_tokens, stats.output_tokens) == (1, 1024, 768, 50)
+    assert stats.cached_input_ratio == 0.75
+
+class SlowFirstResponses:
+    """The first request hangs, the next ones answer at once"""
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+
+    async def create(self, model, input, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        return type('obj', (object,), {'output_text': f'Response {self.calls}'})
+
+def test_slow_call_is_hedged(monkeypatch):
+    monkeypatch.setattr(openai_response_module, "retry_budget", RetryBudget(ratio=0.2, reserve=10))
+    latency = openai_response_module.RouteLatency(min_samples=3)
+    for seconds in (0.01, 0.01, 0.02):
+        latency.record(seconds)
+    monkeypatch.setitem(openai_response_module.route_latency, "extraction", latency)
+    monkeypatch.setattr(openai_response_module, "OPENAI_HEDGE_MIN_DELAY", 0.0)
+
+    openai_response = OpenAI_Response(route="extraction")
+    assert openai_response.model == openai_response_module.OPENAI_EXTRACTION_MODEL
+    responses = SlowFirstResponses()
+    openai_response.client = type('obj', (object,), {'responses': responses})
+
+    async def run():
+        result = await openai_response.get_response("Test system prompt", [{"role": "user", "content": "Test message"}])
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "Response 2"
+    assert (responses.calls, responses.cancelled) == (2, 1)
+    assert (latency.hedges, latency.hedges_won) == (1, 1)
+
+def test_hedge_delay_follows_route_percentile():
+    latency = openai_response_module.RouteLatency(min_samples=10)
+    assert latency.hedge_delay(percentile=90, min_delay=0) is None
+    for i in range(1, 101):
+        latency.record(i / 100)
+    assert latency.hedge_delay(percentile=90, min_delay=0) == 0.91
+    assert latency.hedge_delay(percentile=90, min_delay=2) == 2
+    assert latency.hedge_delay(percentile=0, min_delay=0) is None
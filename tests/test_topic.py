@@ -0,0 +1,41 @@
+import asyncio
+import pytest
+from app import topic as topic_module
+from app.topic import Topic
+
+class MockOpenAIResponse:
+    calls = 0
+
+    def __init__(self, route="debate"):
+        # Extraction runs on its own, cheaper model
+        assert route == "extraction"
+
+    async def get_parsed_response(self, system_prompt, conversation_history, schema):
+        MockOpenAIResponse.calls += 1
+        return schema(topic="Shape of the Earth", user_stance="The Earth is flat", bot_stance="The Earth is round")
+
+@pytest.fixture(autouse=True)
+def mock_openai(monkeypatch):
+    MockOpenAIResponse.calls = 0
+    monkeypatch.setattr(topic_module, "OpenAI_Response", MockOpenAIResponse)
+    monkeypatch.setattr(Topic, "_cache", type(Topic._cache)())
+
+def test_extract_topic_and_stances():
+    topic = asyncio.run(Topic.extract_topic_and_stances("The Earth is flat"))
+    assert topic.topic == "Shape of the Earth"
+    assert topic.user_stance == "The Earth is flat"
+    assert topic.bot_stance == "The Earth is round"
+    assert topic.is_known()
+
+def test_extract_topic_and_stances_is_memoized():
+    asyncio.run(Topic.extract_topic_and_stances("The Earth is flat"))
+    asyncio.run(Topic.extract_topic_and_stances("  the earth   is FLAT! "))
+    assert MockOpenAIResponse.calls == 1
+
+def test_extract_topic_and_stances_failure_is_not_cached(monkeypatch):
+    async def failing(self, system_prompt, conversation_history, schema):
+        return None
+    monkeypatch.setattr(MockOpenAIResponse, "get_parsed_response", failing)
+    topic = asyncio.run(Topic.extract_topic_and_stances("The Earth is flat"))
+    assert not topic.is_known()
+    assert Topic._cache == {}